@@ -1,13 +1,58 @@
+import fcntl
+import multiprocessing
 import os
 import platform
+import re
+import resource
+import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from tempfile import SpooledTemporaryFile
+
+from utils import interpreters
+from utils.metrics import traced
+from utils.retry import retry
 
 class CmdException(Exception):
     pass
 
 
+# Limits the number of commands run by cmd() and cmd2() at the same time, in
+# all threads and in the processes forked afterwards, see set_max_commands()
+_command_slots = None
+
+
+def set_max_commands(n):
+    """
+    Runs at most 'n' commands at the same time, 0 for no limit. The other
+    commands wait for one of them to finish before they start.
+    """
+    global _command_slots
+    if n:
+        _command_slots = multiprocessing.BoundedSemaphore(n)
+    else:
+        _command_slots = None
+
+
+@contextmanager
+def _command_slot():
+    slots = _command_slots
+    if slots is None:
+        yield
+        return
+    slots.acquire()
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+@traced("cmd", lambda s, *args, **kwargs: {"command": s[:200]})
 def cmd(s, cwd=None, capture=False, ok_exit_code_list=[0], echo=False):
     """
     Executes the command "s".
@@ -25,9 +70,10 @@ def cmd(s, cwd=None, capture=False, ok_exit_code_list=[0], echo=False):
         out = subprocess.PIPE
     else:
         out = None
-    p = subprocess.Popen(s, shell=True, stdout=out, stderr=subprocess.STDOUT,
-            cwd=cwd)
-    output = p.communicate()[0]
+    with _command_slot():
+        p = subprocess.Popen(s, shell=True, stdout=out,
+                stderr=subprocess.STDOUT, cwd=cwd)
+        output = p.communicate()[0]
     if output:
         output = output.decode(sys.stdout.encoding)
     r = p.returncode
@@ -36,103 +82,436 @@ def cmd(s, cwd=None, capture=False, ok_exit_code_list=[0], echo=False):
     return output
 
 
-def cmd2(cmd, cwd=None):
+class RunLimits(object):
+    """
+    Limits of a command run by cmd2(), None meaning no limit.
+
+    timeout .............. wall-clock time, in seconds
+    inactivity_timeout ... time without any output, in seconds
+    memory ............... address space of each process, in bytes
+    cpu .................. CPU time of each process, in seconds
+
+    When one of the timeouts is exceeded, the Python processes of the command
+    print the stacks of all their threads to the log (see stackdump/), and
+    then all the processes of the command are killed.
+    """
+
+    def __init__(self, timeout=None, inactivity_timeout=None, memory=None,
+                 cpu=None):
+        self.timeout = timeout
+        self.inactivity_timeout = inactivity_timeout
+        self.memory = memory
+        self.cpu = cpu
+
+    def set_rlimits(self):
+        """
+        Sets the resource limits of the current process, called in the child
+        before the command runs.
+        """
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        if self.cpu:
+            # SIGXCPU at the soft limit dumps the stacks, the hard limit kills
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu,
+                self.cpu + stack_dump_wait))
+        # The stacks are dumped to the log, core files are not needed
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+# Size of the logs of cmd2() kept in memory, longer ones are spooled to disk
+log_memory_size = 1024*1024
+# Size of the chunks of output read by cmd2()
+read_size = 64*1024
+
+
+class CommandLog(object):
+    """
+    Log of the output of a command, see cmd2().
+
+    The log is kept in memory while it is short, and spooled to a temporary
+    file once it is longer than 'log_memory_size'. It is parsed as it is
+    written, line by line, for the test results of the sympy test runner:
+
+    xpassed ... the tests that passed while expected to fail
+    failures ... the tests that failed or raised an exception, as
+    "path/to/test_file.py:test_function"
+    """
+
+    xpassed_header = re.compile(r"^\s*_+\s+xpassed tests\s+_+\s*$")
+    failure_header = re.compile(r"^\s*_+\s+(\S+\.py:\S+)\s+_+\s*$")
+
+    def __init__(self):
+        self._file = SpooledTemporaryFile(max_size=log_memory_size,
+            mode="w+b")
+        self.size = 0
+        self.xpassed = []
+        self.failures = []
+        self._partial = ""
+        self._skip_line = False
+        self._in_xpassed = False
+
+    @classmethod
+    def from_text(cls, text):
+        log = cls()
+        log.write(text)
+        log.close()
+        return log
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Returns the log saved to 'path' (see save()).
+        """
+        log = cls()
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(read_size)
+                if not data:
+                    break
+                log.write(data)
+        log.close()
+        return log
+
+    def write(self, data):
+        """
+        Appends 'data' (bytes in the encoding of the output, or unicode) to
+        the log.
+        """
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding())
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self.size += len(data)
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if self._skip_line:
+                # The end of a line too long to be parsed
+                self._skip_line = False
+                continue
+            self._parse_line(line.decode(self.encoding(), "replace"))
+        if len(self._partial) > read_size:
+            self._partial = ""
+            self._skip_line = True
+
+    def close(self):
+        """
+        Parses the last line, if it does not end with a newline.
+        """
+        if self._partial and not self._skip_line:
+            self._parse_line(self._partial.decode(self.encoding(), "replace"))
+            self._partial = ""
+
+    def _parse_line(self, line):
+        if self._in_xpassed:
+            if line.strip():
+                self.xpassed.append(line)
+                return
+            self._in_xpassed = False
+        if self.xpassed_header.match(line):
+            self._in_xpassed = True
+            return
+        m = self.failure_header.match(line)
+        if m:
+            self.failures.append(m.group(1))
+
+    def __getstate__(self):
+        # Sent to the processes reviewing pull requests with --jobs
+        self._file.seek(0)
+        return {"data": self._file.read(), "xpassed": self.xpassed,
+            "failures": self.failures}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._file.write(state["data"])
+        self.size = len(state["data"])
+        self.xpassed = state["xpassed"]
+        self.failures = state["failures"]
+
+    @staticmethod
+    def encoding():
+        return sys.stdout.encoding or "utf8"
+
+    def read(self):
+        """
+        Returns the whole log, as unicode.
+        """
+        self._file.seek(0)
+        return self._file.read().decode(self.encoding(), "replace")
+
+    def tail(self, length):
+        """
+        Returns the last 'length' characters of the log.
+        """
+        self._file.seek(max(self.size - 4*length, 0))
+        return self._file.read().decode(self.encoding(), "replace")[-length:]
+
+    def save(self, path):
+        """
+        Writes the log to the file 'path'.
+        """
+        self._file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self._file, f, read_size)
+
+    def copy_to(self, log):
+        """
+        Appends the log to the CommandLog 'log'.
+        """
+        self._file.seek(0)
+        while True:
+            data = self._file.read(read_size)
+            if not data:
+                break
+            log.write(data)
+
+
+# Directory with the sitecustomize.py that dumps the stacks on SIGQUIT
+stackdump_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "stackdump")
+# Seconds given to the processes to dump their stacks before being killed
+stack_dump_wait = 5
+
+# The commands of cmd2() running in their own process group, which ^C does
+# not reach, see kill_commands()
+_own_groups = set()
+_own_groups_lock = threading.Lock()
+
+
+@traced("cmd2", lambda cmd, *args, **kwargs: {"command": cmd[:200]})
+def cmd2(cmd, cwd=None, echo=True, abort=None, limits=None):
     """
-    Runs the command "cmd", mirrors everything on the screen and returns a log
-    as well as the return code.
+    Runs the command "cmd", mirrors everything on the screen and returns its
+    log (a CommandLog) as well as the return code.
+
+    echo ... If False, the output is only logged, not mirrored on the screen
+    (useful when several commands run at the same time)
+    abort ... a threading.Event; when it is set, the command and all the
+    processes it started are killed, and the return code is negative
+    limits ... the RunLimits of the command; if it is killed because of a
+    timeout, the return code is None
     """
     print "Running unit tests."
     print "Command:", cmd
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT, cwd=cwd)
-
-    log = ""
-    while True:
-        char = p.stdout.read(1)
-        if not char:
-            break
-        log += char
-        sys.stdout.write(char)
-        sys.stdout.flush()
-    log = log + p.communicate()[0]
-    log = log.decode(sys.stdout.encoding)
+    env = None
+    if limits is not None:
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([stackdump_path] +
+            filter(None, [env.get("PYTHONPATH")]))
+    # With abort or limits, the command runs in its own process group, so
+    # that it can be killed together with its children
+    if abort is not None or limits is not None:
+        preexec_fn = lambda: _setup_child(limits)
+    else:
+        preexec_fn = None
+    with _command_slot():
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, cwd=cwd, env=env,
+                preexec_fn=preexec_fn)
+        # The time of the last output, and the reason for killing the command
+        last_output = [time.time()]
+        timed_out = []
+        if preexec_fn:
+            with _own_groups_lock:
+                _own_groups.add(p)
+            watchdog = threading.Thread(target=_watch, args=(p, abort, limits,
+                last_output, timed_out))
+            watchdog.daemon = True
+            watchdog.start()
+
+        log = CommandLog()
+        fd = p.stdout.fileno()
+        try:
+            while True:
+                # Returns whatever output is available, up to read_size
+                data = os.read(fd, read_size)
+                if not data:
+                    break
+                last_output[0] = time.time()
+                log.write(data)
+                if echo:
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            # ^C does not reach a separate process group
+            if preexec_fn:
+                _kill_group(p)
+            raise
+        finally:
+            if preexec_fn:
+                with _own_groups_lock:
+                    _own_groups.discard(p)
+        p.stdout.close()
+        p.wait()
     r = p.returncode
+    if timed_out:
+        log.write("\n> Timeout: %s, killed\n" % timed_out[0])
+        r = None
+    elif abort is not None and abort.is_set() and r < 0:
+        log.write("\n> Aborted after a failure elsewhere\n")
+    log.close()
 
     return log, r
 
 
-def get_interpreter_version_info(interpreter):
-    """
-    Get python version of `interpreter`
+def _setup_child(limits):
+    os.setsid()
+    if limits is not None:
+        limits.set_rlimits()
+
+
+def _kill_group(p):
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except OSError:
+        # It has already finished
+        return
+    # Processes that ignore SIGTERM (or hang in C code) get SIGKILL
+    deadline = time.time() + stack_dump_wait
+    while p.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def kill_commands():
     """
+    Kills all commands of cmd2() that run in their own process group (with
+    'abort' or 'limits'), and the processes they started.
 
-    code = "import sys; print('%s.%s.%s-%s-%s' % sys.version_info[:])"
-    cmd = '%s -c "%s"' % (interpreter, code)
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-    ouput = p.stdout.read()
+    ^C only interrupts the main thread, so the commands that other threads
+    run this way are not stopped by it, see wait_for_commands().
+    """
+    with _own_groups_lock:
+        processes = list(_own_groups)
+    for p in processes:
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + stack_dump_wait
+    while any(p.poll() is None for p in processes) and \
+            time.time() < deadline:
+        time.sleep(0.1)
+    for p in processes:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
 
-    return ouput.strip()
 
+def wait_for_commands(result):
+    """
+    Returns the result of 'result', the AsyncResult of threads that run
+    commands with cmd2().
 
-def get_interpreter_type(interpreter):
-    # TODO: support other alternate pythons
-    code = """
-import sys
-if hasattr(sys, 'pypy_version_info'):
-    print('PyPy %s.%s.%s-%s-%s;' % sys.pypy_version_info[:])
-else:
-    print('Python')
+    On ^C, the commands are killed (see kill_commands()) and the threads are
+    waited for before KeyboardInterrupt is raised again, so that nothing
+    keeps running in a workspace the caller is about to remove.
+    """
+    try:
+        # A timeout is needed to be able to interrupt the wait with ^C
+        return result.get(2**31)
+    except KeyboardInterrupt:
+        print "> Interrupted, killing the commands that are still running"
+        while not result.ready():
+            # Also the ones that threads start in the meantime
+            kill_commands()
+            result.wait(1)
+        raise
+
+
+def _watch(p, abort, limits, last_output, timed_out):
     """
-    cmd = '%s -c "%s"' % (interpreter, code)
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-    ouput = p.stdout.read()
+    Kills the command run by cmd2() when 'abort' is set or when it exceeds
+    one of the timeouts of 'limits'.
+    """
+    started = time.time()
+    while p.poll() is None:
+        if abort is not None and abort.is_set():
+            _kill_group(p)
+            return
+        now = time.time()
+        if limits is not None and limits.timeout and \
+                now - started > limits.timeout:
+            timed_out.append("ran for more than %d seconds" % limits.timeout)
+        elif limits is not None and limits.inactivity_timeout and \
+                now - last_output[0] > limits.inactivity_timeout:
+            timed_out.append("no output for %d seconds" %
+                limits.inactivity_timeout)
+        if timed_out:
+            try:
+                os.killpg(p.pid, signal.SIGQUIT)
+            except OSError:
+                return
+            time.sleep(stack_dump_wait)
+            _kill_group(p)
+            return
+        if abort is not None:
+            abort.wait(1)
+        else:
+            time.sleep(1)
+
+
+class CommandRunner(object):
+    """
+    Runs functions in the background, at most 'max_concurrent' at the same
+    time, so that for example git fetches overlap with test runs.
+
+    call() returns a multiprocessing.pool.AsyncResult, whose get() returns
+    the result of the function or raises its exception. Commands running in
+    the background should not echo, as their output would be mixed with the
+    output of the foreground. The commands they run count against the
+    limit of set_max_commands(), like all others.
+    """
+
+    def __init__(self, max_concurrent=2):
+        self._pool = ThreadPool(max_concurrent)
 
-    return ouput.strip()
+    def call(self, f, *args, **kwargs):
+        return self._pool.apply_async(f, args, kwargs)
 
+    def close(self):
+        """
+        Waits for the commands that were started, and stops the threads.
+        """
+        self._pool.close()
+        self._pool.join()
 
-def get_executable(interpreter):
-    path = os.environ['PATH']
-    paths = path.split(os.pathsep)
-    # Add .exe extension for Windows
-    if os.name == "nt":
-        interpreter = os.path.splitext(interpreter)[0] + ".exe"
-    if os.path.isfile(interpreter):
-        return interpreter
-    for p in paths:
-        f = os.path.join(p, interpreter)
-        if os.path.isfile(f):
-            return f
+
+def get_interpreter_version_info(interpreter):
+    """
+    Get python version of `interpreter`
+    """
+    return interpreters.registry.get(interpreter)["python_version"]
+
+
+def get_interpreter_type(interpreter):
+    # TODO: support other alternate pythons
+    return interpreters.registry.get(interpreter)["python_type"]
 
 
 def get_platform_version(interpreter):
-    code = 'import sys; print(getattr(sys, \\"maxint\\", None))'
-    call = '%s -c "%s"' % (interpreter, code)
-    size = cmd(call, capture=True)
-    if size == 'None\n':  # Python 3 doesn't have maxint, 2.5 doesn't have maxsize
-        code = 'import sys; print(sys.maxsize)'
-        call = '%s -c "%s"' % (interpreter, code)
-        size = cmd(call, capture=True)
-    size = int(size)
-    if size > 2**32:
+    info = interpreters.registry.get(interpreter)
+    if info["maxsize"] is None:
+        raise CmdException("Could not run the interpreter %s: %s" %
+            (interpreter, info["python_version"]))
+    if info["maxsize"] > 2**32:
         architecture = "64-bit"
     else:
         architecture = "32-bit"
     platform_system = platform.system()
     # TODO: This doesn't recognize bin/test -C (issue #121)
     use_cache = os.getenv('SYMPY_USE_CACHE', 'yes').lower()
-    executable = get_executable(interpreter)
-    python_version = get_interpreter_version_info(interpreter)
-    python_type = get_interpreter_type(interpreter)
 
-    return {'executable': executable,
-            'python_version': python_version,
+    return {'executable': info["executable"],
+            'python_version': info["python_version"],
             'platform_system': platform_system,
             'architecture': architecture,
             'use_cache': use_cache,
             'additional_info': "",
-            'python_type': python_type,
+            'python_type': info["python_type"],
     }
 
 
@@ -145,9 +524,31 @@ def get_sphinx_version():
     r = " %s" % version
     return {'sphinx_version': r, 'additional_info': ""}
 
+class FileLock(object):
+    """
+    Exclusive lock on the file 'path', held inside a with statement.
+
+    It excludes other processes as well as other threads of this process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, "w")
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
 def keep_trying(command, errors, what_did, on_except=None):
     """
-    Keep trying command, using a time doubling scheme.
+    Keep trying command, see utils.retry.retry(), which this calls with the
+    default retry policy and without a circuit breaker.
 
     Parameters
     ----------
@@ -165,35 +566,8 @@ def keep_trying(command, errors, what_did, on_except=None):
         single argument, the error that was caught.  If the function returns a
         non-None value, that is returned.  Otherwise, it retries.
 
-    It tries `command()`, and if it raises one of the errors in `errors`, it
-    prints an error message based on `what_did`, then tries again in one
-    second. If it fails again, it tries again in two seconds, then four
-    seconds, and so on (doubling each time).
-
-    This "time doubling" scheme mimics other systems such as the Google
-    AppEngine uploader and GMail, and is useful to give fast response time for
-    minor blips, but avoids DoSing the server, which can often make the
-    problem worse (e.g., if the reason the request failed is that you hit a
-    quota).
-
     The return value is the same as the return value of `command()`, or
     `on_except()` if that was run and returned non-None.
 
     """
-    timer = 1
-
-    while True:
-        try:
-            result = command()
-            break
-        except errors as e:
-            if on_except:
-                a = on_except(e)
-                if a is not None:
-                    return a
-
-            print "Could not %s, retrying in %d seconds..." % (what_did, timer)
-            time.sleep(timer)
-            timer *= 2
-
-    return result
+    return retry(command, errors, what_did, on_except=on_except)
@@ -0,0 +1,305 @@
+"""
+Long running review daemon.
+
+Pull requests to review come from a GitHub webhook endpoint (see
+WebhookServer) and from polling the list of pull requests (see Poller). They
+are put into a JobQueue, which holds every pull request at most once, and are
+reviewed by a pool of worker threads (see ReviewDaemon).
+"""
+
+import BaseHTTPServer
+import hashlib
+import hmac
+import json
+import threading
+import time
+import traceback
+import urlparse
+
+from utils.github import (github_invalidate_pull_request,
+    github_iter_pull_requests)
+
+
+class JobQueue(object):
+    """
+    Queue of pull request numbers to review.
+
+    A pull request is queued at most once. If it is queued again while it is
+    being reviewed, it is reviewed once more when the current review is done
+    (as the review might already be out of date).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = []
+        self._running = set()
+        self._rerun = set()
+        self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
+
+    def put(self, n):
+        """
+        Queues pull request 'n'. Returns False if it was already queued.
+        """
+        with self._cond:
+            if n in self._queue or n in self._rerun:
+                return False
+            if n in self._running:
+                self._rerun.add(n)
+            else:
+                self._queue.append(n)
+                self._cond.notify()
+            return True
+
+    def get(self):
+        """
+        Returns the next pull request to review, waiting for one if the queue
+        is empty. Returns None once the queue is closed.
+        """
+        with self._cond:
+            while not self._queue and not self._closed:
+                # A timeout is needed to be able to interrupt the wait with ^C
+                self._cond.wait(1)
+            if self._closed:
+                return None
+            n = self._queue.pop(0)
+            self._running.add(n)
+            return n
+
+    def done(self, n):
+        """
+        Marks the review of pull request 'n' as finished.
+        """
+        with self._cond:
+            self._running.discard(n)
+            if n in self._rerun:
+                self._rerun.discard(n)
+                self._queue.append(n)
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the "pull_request" events of a GitHub webhook.
+    """
+
+    review_actions = {"opened", "reopened", "synchronize"}
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        secret = self.server.secret
+        if secret:
+            signature = "sha1=" + hmac.new(secret, body, hashlib.sha1).hexdigest()
+            # In constant time, so that the signature cannot be guessed by
+            # timing the replies
+            if not hmac.compare_digest(self.headers.get("X-Hub-Signature", ""),
+                    signature):
+                self.send_error(403, "Invalid signature")
+                return
+
+        event = self.headers.get("X-GitHub-Event", "pull_request")
+        if event == "ping":
+            self._reply(200, "pong")
+            return
+        if event != "pull_request":
+            self._reply(202, "Ignored event %s" % event)
+            return
+
+        if self.headers.get("Content-Type", "").startswith(
+                "application/x-www-form-urlencoded"):
+            body = urlparse.parse_qs(body).get("payload", [""])[0]
+        try:
+            payload = json.loads(body)
+            action = payload["action"]
+            n = int(payload["number"])
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, "Could not parse the pull request event")
+            return
+
+        # Whatever the action, the cached pull request is out of date
+        github_invalidate_pull_request(self.server.urls, n)
+        if action not in self.review_actions:
+            self._reply(202, "Ignored action %s" % action)
+            return
+        if self.server.job_queue.put(n):
+            print "> Webhook: queued pull request #%d (%s)" % (n, action)
+            self._reply(202, "Queued pull request #%d" % n)
+        else:
+            self._reply(202, "Pull request #%d is already queued" % n)
+
+    def _reply(self, code, message):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.wfile.write(message + "\n")
+
+    def log_message(self, format, *args):
+        print "> Webhook: %s" % (format % args)
+
+
+class WebhookServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server accepting GitHub webhook requests at 'address'.
+
+    secret ... the secret configured for the webhook on GitHub; if given,
+    requests without a valid signature are rejected
+    """
+
+    def __init__(self, address, urls, job_queue, secret=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, WebhookHandler)
+        self.urls = urls
+        self.job_queue = job_queue
+        self.secret = secret
+
+
+class Poller(threading.Thread):
+    """
+    Polls the list of open pull requests every 'interval' seconds, and queues
+    the ones that are new or whose head has changed since the previous poll.
+
+    The first poll only records the current state, unless 'review_existing'
+    is True, in which case all open pull requests are queued.
+    """
+
+    def __init__(self, urls, job_queue, interval, review_existing=False):
+        threading.Thread.__init__(self, name="poller")
+        self.daemon = True
+        self.urls = urls
+        self.job_queue = job_queue
+        self.interval = interval
+        self._heads = {}
+        self._seeded = review_existing
+        # The PageIterator of the current poll
+        self._pages = None
+        self._polled_heads = {}
+        self._stopped = threading.Event()
+
+    def poll(self):
+        if self._pages is None:
+            self._pages = github_iter_pull_requests(self.urls)
+            self._polled_heads = {}
+        # Pull requests are queued page by page. If the previous poll failed,
+        # this one resumes from the page it stopped at.
+        for pull in self._pages:
+            n = pull["number"]
+            head = pull["head"]["sha"]
+            if self._polled_heads.get(n) == head:
+                # Seen before the previous poll failed
+                continue
+            self._polled_heads[n] = head
+            if not self._seeded:
+                continue
+            if self._heads.get(n) != head:
+                github_invalidate_pull_request(self.urls, n)
+                if self.job_queue.put(n):
+                    print "> Poller: queued pull request #%d" % n
+        self._heads = self._polled_heads
+        self._pages = None
+        self._seeded = True
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                # Whatever the error, polling must go on
+                print "> Poller: could not poll the pull requests:"
+                traceback.print_exc()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class ReviewDaemon(object):
+    """
+    Reviews pull requests as they are opened or updated.
+
+    review .......... function reviewing one pull request, called with its
+    number from one of the worker threads
+    address ......... (host, port) of the webhook endpoint, or None
+    workers ......... number of pull requests reviewed at the same time
+    poll_interval ... seconds between polls of the pull request list, or None
+    to not poll
+    """
+
+    def __init__(self, review, urls, address=None, workers=1,
+                 poll_interval=None, secret=None, review_existing=False):
+        self.review = review
+        self.job_queue = JobQueue()
+        self.server = None
+        self.poller = None
+        self.workers = []
+        if address:
+            self.server = WebhookServer(address, urls, self.job_queue,
+                secret)
+        if poll_interval:
+            self.poller = Poller(urls, self.job_queue, poll_interval,
+                review_existing)
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name="worker-%d" % i)
+            worker.daemon = True
+            self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            n = self.job_queue.get()
+            if n is None:
+                break
+            print "> Reviewing pull request #%d (%d more queued)" % (n,
+                len(self.job_queue))
+            try:
+                self.review(n)
+            except SystemExit:
+                print "> Review of pull request #%d aborted" % n
+            except Exception:
+                print "> Review of pull request #%d failed:" % n
+                traceback.print_exc()
+            finally:
+                self.job_queue.done(n)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        if self.poller:
+            self.poller.start()
+        if self.server:
+            thread = threading.Thread(target=self.server.serve_forever,
+                name="webhook")
+            thread.daemon = True
+            thread.start()
+            host, port = self.server.server_address
+            print "> Listening for webhooks on http://%s:%d/" % (host, port)
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.poller:
+            self.poller.stop()
+        self.job_queue.close()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
+
+    def serve_forever(self):
+        """
+        Starts the daemon and runs until interrupted with ^C.
+        """
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print "\n> Shutting down, waiting for the running reviews"
+            self.shutdown()
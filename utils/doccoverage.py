@@ -0,0 +1,251 @@
+"""
+Doctest coverage (bin/coverage_doctest.py) of master and of pull requests.
+
+The coverage of master is computed at most once per master commit and cached
+on disk (see MasterDocCoverage). The coverage of a pull request is then
+computed by only analyzing the modules it changes, and correcting the totals
+of master by the difference (see run_doc_coverage()).
+"""
+
+import codecs
+import os
+import re
+import shutil
+from tempfile import mkstemp
+
+from utils.cmd import cmd, cmd2, FileLock
+from utils.testrunner import create_worktree
+
+score_re = re.compile(r"TOTAL (DOCTEST|SPHINX) SCORE for (\S+): (\d+)% \((\d+) of (\d+)\)")
+
+
+def parse_doc_coverage(log):
+    """
+    Parses the totals printed by coverage_doctest.py.
+
+    Returns a dict mapping "DOCTEST" and "SPHINX" to a (covered, total)
+    tuple, or None if the totals could not be found.
+    """
+    scores = {}
+    for m in score_re.finditer(log):
+        scores[m.group(1)] = (int(m.group(4)), int(m.group(5)))
+    if set(scores) != {"DOCTEST", "SPHINX"}:
+        return None
+    return scores
+
+
+def format_doc_coverage(scores, name="sympy"):
+    """
+    Formats 'scores' (see parse_doc_coverage()) the way coverage_doctest.py
+    prints its totals.
+    """
+    lines = []
+    for kind in ["DOCTEST", "SPHINX"]:
+        covered, total = scores[kind]
+        percent = 100*covered//total if total else 0
+        lines.append("TOTAL %s SCORE for %s: %d%% (%d of %d)" % (kind, name,
+            percent, covered, total))
+    return "\n".join(lines) + "\n"
+
+
+def get_changed_modules(repo_path, master_hash, package="sympy"):
+    """
+    Returns the modules of 'package' that are analyzed by coverage_doctest.py
+    and that differ between 'master_hash' and the checkout at 'repo_path'.
+    """
+    output = cmd("git diff --name-only %s HEAD -- %s" % (master_hash, package),
+        capture=True, cwd=repo_path)
+    modules = []
+    for path in output.split():
+        parts = path.split("/")
+        if not path.endswith(".py") or parts[-1] == "__init__.py":
+            continue
+        # coverage_doctest.py does not analyze the tests
+        if "tests" in parts or "benchmarks" in parts:
+            continue
+        modules.append(path)
+    return modules
+
+
+def _exists_in(repo_path, commit, path):
+    output = cmd("git ls-tree --name-only %s -- %s" % (commit, path),
+        capture=True, cwd=repo_path)
+    return bool(output.strip())
+
+
+def _read(filename):
+    try:
+        with open(filename) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+class MasterDocCoverage(object):
+    """
+    Doctest coverage of master, computed at most once per master commit.
+
+    The logs of coverage_doctest.py are cached on disk in 'cache_dir', in one
+    directory per master commit. To compute them, master is checked out in a
+    separate working tree of 'master_repo_path' under 'workspace_base', and
+    its docs are built there (the Sphinx score needs the HTML docs), so the
+    checkout of the pull request is never touched. There is a single such
+    working tree, which is moved to the new master commit when master
+    changes, so that only the changed documents are built again. Concurrent
+    reviews wait for each other instead of computing the same coverage twice.
+    For that, 'build_docs_command' must not clean the build directory. If the
+    docs cannot be built, the coverage is not cached.
+
+    At most 'max_commits' master commits are kept in the cache.
+    """
+
+    def __init__(self, cache_dir, master_repo_path, workspace_base,
+                 coverage_command, build_docs_dir, build_docs_command,
+                 max_commits=10):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.master_repo_path = master_repo_path
+        self.workspace_base = workspace_base
+        self.coverage_command = coverage_command
+        self.build_docs_dir = build_docs_dir
+        self.build_docs_command = build_docs_command
+        self.max_commits = max_commits
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get_log(self, master_hash, module=None):
+        """
+        Returns the log of coverage_doctest.py for 'module' (or for all of
+        sympy, if it is None) at 'master_hash'.
+        """
+        commit_dir = os.path.join(self.cache_dir, master_hash)
+        filename = os.path.join(commit_dir,
+            (module or "sympy").replace("/", ".") + ".log")
+        if not os.path.isfile(filename):
+            with self._lock():
+                # Another review might have computed it in the meantime
+                if not os.path.isfile(filename):
+                    workspace, docs_built = self._get_workspace(master_hash)
+                    command = self.coverage_command
+                    if module:
+                        command += " " + module
+                    print "> Running coverage_doctest.py against master"
+                    log, r = cmd2(command, cwd=workspace)
+                    if not docs_built:
+                        # Its Sphinx score is wrong, don't keep it
+                        return log.read()
+                    if not os.path.isdir(commit_dir):
+                        os.makedirs(commit_dir)
+                    fd, tmp = mkstemp(dir=commit_dir)
+                    os.close(fd)
+                    log.save(tmp)
+                    os.rename(tmp, filename)
+        # Mark as recently used
+        os.utime(commit_dir, None)
+        with codecs.open(filename, encoding="utf8") as f:
+            return f.read()
+
+    def _lock(self):
+        return FileLock(os.path.join(self.workspace_base, "master.lock"))
+
+    def _get_workspace(self, master_hash):
+        """
+        Returns the working tree of master, checked out at 'master_hash' with
+        its docs built, and whether the docs could be built. Must be called
+        with the lock held.
+        """
+        workspace = os.path.join(self.workspace_base, "master")
+        # The master commit whose docs were built in the working tree
+        built = os.path.join(self.workspace_base, "master.built")
+        if not os.path.isdir(workspace):
+            create_worktree(self.master_repo_path, workspace, master_hash)
+        elif _read(built) != master_hash:
+            # Only the files that changed are touched, and the ignored build
+            # directory is kept, so Sphinx only builds them again
+            cmd("git checkout --force --detach %s && git clean -fd" %
+                master_hash, cwd=workspace)
+        if _read(built) != master_hash:
+            print "> Building Sphinx docs of master"
+            log, r = cmd2(self.build_docs_command, cwd=os.path.join(workspace,
+                self.build_docs_dir))
+            if r != 0:
+                print "> Building the Sphinx docs of master failed"
+                return workspace, False
+            with open(built, "w") as f:
+                f.write(master_hash)
+        return workspace, True
+
+    def evict(self):
+        """
+        Removes the cached coverage of all but the 'max_commits' most
+        recently used master commits.
+        """
+        commit_dirs = [os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)]
+        commit_dirs = sorted((os.path.getmtime(d), d) for d in commit_dirs
+            if os.path.isdir(d))
+        for _, commit_dir in commit_dirs[:-self.max_commits]:
+            shutil.rmtree(commit_dir, ignore_errors=True)
+
+
+def run_doc_coverage(master_doc_coverage, repo_path, master_hash):
+    """
+    Runs coverage_doctest.py for the pull request checked out at 'repo_path'
+    (whose docs must be built), merged into 'master_hash'.
+
+    Only the modules changed by the pull request are analyzed; the totals
+    for all of sympy are those of master, corrected by the difference in the
+    changed modules. If any of the logs cannot be parsed, all of sympy is
+    analyzed instead.
+
+    Returns a dict with the "result" ("Passed" or "Failed") and the "log",
+    and the log of master.
+    """
+    master_log = master_doc_coverage.get_log(master_hash)
+    scores = parse_doc_coverage(master_log)
+    command = master_doc_coverage.coverage_command
+
+    if scores is not None:
+        scores = {kind: list(score) for kind, score in scores.iteritems()}
+        modules = get_changed_modules(repo_path, master_hash)
+        print "> Analyzing the %d changed modules" % len(modules)
+        log = ""
+        r = 0
+        for module in modules:
+            if _exists_in(repo_path, "HEAD", module):
+                module_log, module_r = cmd2(command + " " + module,
+                    cwd=repo_path)
+                module_log = module_log.read()
+                module_scores = parse_doc_coverage(module_log)
+                if module_scores is None:
+                    scores = None
+                    break
+                log += module_log
+                r = r or module_r
+                for kind, (covered, total) in module_scores.iteritems():
+                    scores[kind][0] += covered
+                    scores[kind][1] += total
+            if _exists_in(repo_path, master_hash, module):
+                module_scores = parse_doc_coverage(
+                    master_doc_coverage.get_log(master_hash, module))
+                if module_scores is None:
+                    scores = None
+                    break
+                for kind, (covered, total) in module_scores.iteritems():
+                    scores[kind][0] -= covered
+                    scores[kind][1] -= total
+
+    if scores is None:
+        print "> Analyzing all modules"
+        log, r = cmd2(command, cwd=repo_path)
+        log = log.read()
+    else:
+        log += ("\nTotals of master (%s), corrected by the changed modules:\n"
+            % master_hash)
+        log += format_doc_coverage(scores)
+
+    result = {"log": log}
+    if r == 0:
+        result["result"] = "Passed"
+    else:
+        result["result"] = "Failed"
+    return result, master_log
@@ -0,0 +1,152 @@
+"""
+Incremental builds of the Sphinx docs.
+
+Building the docs from scratch re-reads every source file and re-imports all
+of sympy for autodoc, although a pull request usually touches only a few of
+them. SphinxBuildCache keeps a warm build directory (the HTML output, the
+doctrees and the pickled environment) of every base commit, and copies it
+into the checkout of the pull request before building, so that Sphinx only
+reads and writes again the documents whose sources or dependencies changed.
+
+Sphinx decides what is out of date by comparing the modification times of the
+files with the time it read them. A fresh checkout has arbitrary modification
+times, so the times of all tracked files are set to the commit time of the base
+commit, both when the warm build is made and before the pull request is built,
+and only the files changed by the pull request are touched.
+"""
+
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+from utils.cmd import cmd, cmd2, FileLock
+from utils.testrunner import create_worktree, remove_worktree
+
+
+def set_mtimes(repo_path, commit, changed_since=None):
+    """
+    Sets the modification times of all files tracked in the checkout at
+    'repo_path' to the commit time of 'commit'.
+
+    changed_since ... if given, the files that differ between this commit and
+    the checkout are set to the current time instead
+    """
+    mtime = int(cmd("git log -1 --format=%%ct %s" % commit, capture=True,
+        cwd=repo_path).strip())
+    files = cmd("git ls-files -z", capture=True, cwd=repo_path).split("\0")
+    for path in files:
+        path = os.path.join(repo_path, path)
+        if path != repo_path and os.path.isfile(path):
+            os.utime(path, (mtime, mtime))
+    if changed_since:
+        changed = cmd("git diff --name-only -z %s HEAD" % changed_since,
+            capture=True, cwd=repo_path).split("\0")
+        now = time.time()
+        for path in changed:
+            path = os.path.join(repo_path, path)
+            if path != repo_path and os.path.isfile(path):
+                os.utime(path, (now, now))
+
+
+class SphinxBuildCache(object):
+    """
+    Warm Sphinx build directories, one per base commit, in 'cache_dir'.
+
+    The warm build of a base commit is made at most once, in a separate working
+    tree of 'master_repo_path' under 'workspace_base', by running
+    'build_command' in its 'build_docs_dir'. It must not clean the build
+    directory 'build_dir' (relative to 'build_docs_dir').
+
+    At most 'max_commits' base commits are kept in the cache.
+    """
+
+    def __init__(self, cache_dir, master_repo_path, workspace_base,
+                 build_docs_dir, build_command, build_dir="_build",
+                 max_commits=3):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.master_repo_path = master_repo_path
+        self.workspace_base = workspace_base
+        self.build_docs_dir = build_docs_dir
+        self.build_command = build_command
+        self.build_dir = build_dir
+        self.max_commits = max_commits
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get_build(self, base_hash):
+        """
+        Returns the path of the warm build directory of 'base_hash', making
+        it if needed, or None if it could not be made.
+        """
+        commit_dir = os.path.join(self.cache_dir, base_hash)
+        build = os.path.join(commit_dir, "build")
+        if not os.path.isdir(build):
+            with FileLock(os.path.join(self.cache_dir, base_hash + ".lock")):
+                # Another review might have made it in the meantime
+                if not os.path.isdir(build):
+                    self._make_build(base_hash, commit_dir)
+        if not os.path.isdir(build):
+            return None
+        # Mark as recently used
+        os.utime(commit_dir, None)
+        return build
+
+    def _make_build(self, base_hash, commit_dir):
+        workspace = os.path.join(self.workspace_base, "docs-%s" % base_hash)
+        create_worktree(self.master_repo_path, workspace, base_hash)
+        try:
+            set_mtimes(workspace, base_hash)
+            print "> Building Sphinx docs of %s for incremental builds" % base_hash
+            docs_path = os.path.join(workspace, self.build_docs_dir)
+            cmd2(self.build_command, cwd=docs_path)
+            build = os.path.join(docs_path, self.build_dir)
+            if not os.path.isfile(os.path.join(build, "doctrees",
+                    "environment.pickle")):
+                # Sphinx stopped before saving its environment, the
+                # build is useless for later builds
+                print "> WARNING: Could not build the docs of %s, building from scratch" % base_hash
+                return
+            if not os.path.isdir(commit_dir):
+                os.makedirs(commit_dir)
+            tmp = mkdtemp(prefix="tmp-", dir=commit_dir)
+            shutil.move(build, os.path.join(tmp, "build"))
+            os.rename(os.path.join(tmp, "build"), os.path.join(commit_dir,
+                "build"))
+            os.rmdir(tmp)
+        finally:
+            remove_worktree(self.master_repo_path, workspace)
+
+    def prepare(self, repo_path, base_hash):
+        """
+        Prepares the checkout at 'repo_path' (a merge into 'base_hash') for an
+        incremental build, by copying the warm build of 'base_hash' into it
+        and setting the modification times of its files.
+
+        Returns False if there is no warm build, in which case the docs have
+        to be built from scratch.
+        """
+        build = self.get_build(base_hash)
+        if build is None:
+            return False
+        set_mtimes(repo_path, base_hash, changed_since=base_hash)
+        dst = os.path.join(repo_path, self.build_docs_dir, self.build_dir)
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        # copytree() keeps the modification times
+        shutil.copytree(build, dst, symlinks=True)
+        return True
+
+    def evict(self):
+        """
+        Removes the warm builds of all but the 'max_commits' most recently
+        used base commits.
+        """
+        commit_dirs = [os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)]
+        commit_dirs = sorted((os.path.getmtime(d), d) for d in commit_dirs
+            if os.path.isdir(d))
+        for _, commit_dir in commit_dirs[:-self.max_commits]:
+            shutil.rmtree(commit_dir, ignore_errors=True)
+            if os.path.exists(commit_dir + ".lock"):
+                os.remove(commit_dir + ".lock")
@@ -1,15 +1,25 @@
 import base64
+import calendar
 import json
 import sys
+import threading
 import time
 import urllib2
+from collections import OrderedDict
 from getpass import getpass
+from multiprocessing.pool import ThreadPool
 
-from utils.cmd import keep_trying
+from utils.http import urlopen
+from utils.httpcache import HTTPCache
+from utils.metrics import traced
+from utils.retry import retry, is_transient_http_error
 
 class AuthenticationFailed(Exception):
     pass
 
+# The HTTPCache of the responses of GET requests, see set_http_cache()
+_http_cache = None
+
 _login_message = """\
 Enter your GitHub username & password or press ^C to quit. The password
 will be kept as a Python variable as long as sympy-bot is running and
@@ -30,12 +40,134 @@ def generate_token(urls, username, password, name="SymPy Bot"):
     return rep["token"]
 
 
+class EntityCache(object):
+    """
+    In-memory cache of the objects (pull requests, users, repositories)
+    fetched from GitHub, so that each is fetched once per run instead of
+    once per use.
+
+    ttls .......... dict mapping each kind of object to the time in seconds
+    it is reused for
+    max_entries ... maximum number of objects kept; the least recently used
+    ones are dropped first
+
+    Concurrent get()s of the same object wait for a single fetch.
+    """
+
+    def __init__(self, ttls, max_entries=2000):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, url, fetch):
+        """
+        Returns the object of 'kind' at 'url', calling 'fetch' to get it if
+        it is not cached or has expired. Errors raised by 'fetch' are not
+        cached.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.pop(url, None)
+                if entry and time.time() - entry[0] <= self.ttls[kind]:
+                    self._entries[url] = entry
+                    return entry[1]
+                fetching = self._fetching.get(url)
+                if fetching is None:
+                    fetching = self._fetching[url] = threading.Event()
+                    break
+            fetching.wait()
+        try:
+            value = fetch()
+            with self._lock:
+                self._entries[url] = (time.time(), value)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._fetching[url]
+            fetching.set()
+        return value
+
+    def invalidate(self, url):
+        """
+        Drops the object at 'url', after it changed.
+        """
+        with self._lock:
+            self._entries.pop(url, None)
+
+
+# Pull requests change the most often, and are invalidated by the daemon
+# when they do
+_entities = EntityCache({"pull": 15*60, "user": 24*60*60, "repos": 60*60})
+
+
+def set_http_cache(cache):
+    """
+    Revalidates and reuses the responses cached in the HTTPCache 'cache',
+    None to not cache them.
+    """
+    global _http_cache
+    _http_cache = cache
+
+def _retry(command, what_did, url, on_except=None):
+    """
+    Calls 'command', a query of 'url', until it does not fail with a
+    transient error, see utils.retry.retry().
+    """
+    return retry(command, urllib2.URLError, what_did, endpoint=url,
+                 on_except=on_except, is_transient=is_transient_http_error)
+
+def per_page(url, n=100):
+    """
+    Returns 'url' asking for 'n' items per page (100 is the most GitHub
+    returns).
+    """
+    if "per_page=" in url:
+        return url
+    return "%s%sper_page=%d" % (url, "&" if "?" in url else "?", n)
+
+class PageIterator(object):
+    """
+    Iterates over the items of the multipage result of the GitHub API at
+    'url', fetching each page only when its items are needed.
+
+    So that the first items can be used while the next pages are fetched,
+    and that no more pages are fetched once the iteration is stopped, e.g. at
+    the first pull request older than some date (pull requests are listed
+    newest first).
+
+    cursor ... the URL of the first page whose items were not all iterated
+    over, or None once they all were. It can be saved, and passed instead of
+    'url' to resume the iteration (the items of that page are iterated over
+    again).
+    """
+
+    def __init__(self, url=None, cursor=None, what="get list"):
+        self.cursor = cursor or per_page(url)
+        self.what = what
+
+    def __iter__(self):
+        while self.cursor:
+            url = self.cursor
+            page, nexturl = _retry(lambda: _query_page(url), self.what, url)
+            for item in page:
+                yield item
+            self.cursor = nexturl
+
+def github_iter_pull_requests(urls, cursor=None):
+    """
+    Returns a PageIterator over the open github pull requests, newest first.
+    """
+    return PageIterator(urls.pull_list_url, cursor,
+                        "get list of all pull requests")
+
 def github_get_pull_request_all(urls):
     """
     Returns all github pull requests.
     """
-    return keep_trying(lambda: _query(urls.pull_list_url), urllib2.URLError,
-                       "get list of all pull requests")
+    return list(github_iter_pull_requests(urls))
 
 def github_get_pull_request(urls, n):
     """
@@ -58,16 +190,25 @@ def github_get_pull_request(urls, n):
                    "(no code is attached). Skipping..." % n)
             return False
 
-    return keep_trying(lambda: _query(url), urllib2.URLError,
-                       "get pull request %d" % n, _check_issue)
+    return _entities.get("pull", url, lambda: _retry(lambda: _query(url),
+        "get pull request %d" % n, url, _check_issue))
+
+def github_invalidate_pull_request(urls, n):
+    """
+    Makes the next github_get_pull_request() of pull request 'n' fetch it
+    again, after it changed.
+    """
+    _entities.invalidate(urls.single_pull_template % n)
 
 def github_get_user_info(urls, username):
     url = urls.user_info_template % username
-    return keep_trying(lambda: _query(url), urllib2.URLError, "get user information")
+    return _entities.get("user", url, lambda: _retry(lambda: _query(url),
+        "get user information", url))
 
 def github_get_user_repos(urls, username):
-    url = urls.user_repos_template % username
-    return keep_trying(lambda: _query(url), urllib2.URLError, "get user repository information")
+    url = per_page(urls.user_repos_template % username)
+    return _entities.get("repos", url, lambda: _retry(lambda: _query(url),
+        "get user repository information", url))
 
 def github_check_authentication(urls, username, password, token):
     """
@@ -92,49 +233,82 @@ def github_add_comment_to_pull_request(urls, username, password, token, n, comme
     assert response["body"] == comment
 
 
-def github_list_pull_requests(urls, numbers_only=False):
+def github_get_pull_request_infos(urls, concurrency=8):
     """
-    Returns the pull requests numbers.
+    Returns the information about all pull requests needed to list and
+    schedule them, sorted by date of creation.
 
-    It returns a tuple of (nonmergeable, mergeable), where "nonmergeable"
-    and "mergeable" are lists of the pull requests numbers.
+    Each pull request is a dict with the keys 'n', 'repo', 'branch',
+    'head_sha', 'author', 'mergeable', 'branch_against', and 'created_at'
+    and 'updated_at' in seconds since the epoch.
+
+    concurrency ... maximum number of pull requests and authors fetched from
+    GitHub at the same time
     """
-    pulls = github_get_pull_request_all(urls)
-    formatted_pulls = []
-    print "Total pull count", len(pulls)
     sys.stdout.write("Processing pulls...")
-    for pull in pulls:
-        n = pull["number"]
-        sys.stdout.write(" %d" % n)
-        sys.stdout.flush()
-        pull_info = github_get_pull_request(urls, n)
+    lock = threading.Lock()
+
+    def _get_pull_request(pull):
+        pull_info = github_get_pull_request(urls, pull["number"])
+        # Authors of several pull requests are fetched once, see EntityCache
+        user_info = github_get_user_info(urls, pull["user"]["login"])
+        with lock:
+            sys.stdout.write(" %d" % pull["number"])
+            sys.stdout.flush()
+        return pull, pull_info, user_info
+
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        # The pull requests of the first pages are processed while the next
+        # pages are fetched
+        pending = [pool.apply_async(_get_pull_request, (pull,))
+            for pull in github_iter_pull_requests(urls)]
+        results = [result.get() for result in pending]
+    finally:
+        pool.close()
+        pool.join()
+    print
+    print "Total pull count", len(results)
+
+    formatted_pulls = []
+    for pull, pull_info, user_info in results:
         if not pull_info:
             # Pull request is an issue
             continue
-        mergeable = pull_info["mergeable"]
         if pull["head"]["repo"]:
             repo = pull["head"]["repo"]["html_url"]
         else:
             repo = None
-        branch = pull["head"]["ref"]
         created_at = pull["created_at"]
         created_at = time.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ")
         created_at = time.mktime(created_at)
-        username = pull["user"]["login"]
-        user_info = github_get_user_info(urls, username)
+        updated_at = time.strptime(pull["updated_at"], "%Y-%m-%dT%H:%M:%SZ")
+        updated_at = calendar.timegm(updated_at)
         author = "\"%s\" <%s>" % (user_info.get("name", "unknown"),
                                   user_info.get("email", ""))
-        branch_against = pull["base"]["ref"]
         formatted_pulls.append({
             'created_at': created_at,
-            'n': n,
+            'updated_at': updated_at,
+            'n': pull["number"],
             'repo': repo,
-            'branch': branch,
+            'branch': pull["head"]["ref"],
+            'head_sha': pull["head"]["sha"],
             'author': author,
-            'mergeable': mergeable,
-            'branch_against': branch_against,
+            'mergeable': pull_info["mergeable"],
+            'branch_against': pull["base"]["ref"],
         })
     formatted_pulls.sort(key=lambda x: x['created_at'])
+    return formatted_pulls
+
+
+def github_list_pull_requests(urls, numbers_only=False, concurrency=8):
+    """
+    Returns the pull requests numbers.
+
+    It returns a tuple of (nonmergeable, mergeable), where "nonmergeable"
+    and "mergeable" are lists of the pull requests numbers.
+    """
+    formatted_pulls = github_get_pull_request_infos(urls, concurrency)
     print "\nPatches that cannot be merged without conflicts:"
     nonmergeable = []
     for pull in formatted_pulls:
@@ -242,13 +416,29 @@ def _link2dict(l):
     return d
 
 
-def _query(url, username=None, password=None, token=None, data="", OTP=None):
+def _query(url, username=None, password=None, token=None, data=""):
     """
     Query github API,
     if username and password are presented, then the query is executed from the user account
 
     In case of a multipage result, query the next page and return all results.
     """
+    response_body, nexturl = _query_page(url, username, password, token, data)
+    while nexturl:
+        page, nexturl = _query_page(nexturl, username, password, token, data)
+        response_body.extend(page)
+    return response_body
+
+
+@traced("github", lambda url, *args, **kwargs: {"url": url})
+def _query_page(url, username=None, password=None, token=None, data="",
+                OTP=None):
+    """
+    Makes a single query of the github API, see _query().
+
+    Returns the response and the URL of the next page of a multipage result,
+    None if it is the last page.
+    """
     request = urllib2.Request(url)
     # Add authentication headers to request, if username and password presented
     if username:
@@ -263,9 +453,21 @@ def _query(url, username=None, password=None, token=None, data="", OTP=None):
 
     if data is not "":
         request.add_data(data)
+    cache_key = None
+    cached = None
+    if _http_cache is not None and not data:
+        cache_key = HTTPCache.key(url, request.get_header("Authorization"))
+        cached = _http_cache.get(cache_key)
+        if cached:
+            if cached["etag"]:
+                request.add_header("If-None-Match", cached["etag"])
+            if cached["last_modified"]:
+                request.add_header("If-Modified-Since",
+                    cached["last_modified"])
     try:
-        http_response = urllib2.urlopen(request)
-        response_body = json.load(http_response)
+        http_response = urlopen(request)
+        body = http_response.read()
+        response_body = json.loads(body)
     except urllib2.HTTPError as e:
         # Auth exception
         if e.code == 401:
@@ -273,21 +475,30 @@ def _query(url, username=None, password=None, token=None, data="", OTP=None):
             if two_factor:
                 print "A two-factor authentication code is required: ", two_factor[0].split(';')[1].strip()
                 OTP = raw_input("Authentication code: ")
-                return _query(url, username=username, password=password,
-                    token=token, data=data, OTP=OTP)
+                return _query_page(url, username=username,
+                    password=password, token=token, data=data, OTP=OTP)
             raise AuthenticationFailed("invalid username or password")
-        # Other exceptions
-        raise urllib2.HTTPError(e.filename, e.code, e.msg, None, None)
+        if e.code != 304 or not cached:
+            # Other exceptions
+            raise urllib2.HTTPError(e.filename, e.code, e.msg, None, None)
+        # Not modified since it was cached, which does not count against
+        # the rate limit
+        _http_cache.touch(cache_key)
+        response_body = json.loads(cached["body"])
+        link = cached["link"]
     except ValueError as e:
         # If auth was successful
         if http_response.code in (204, 302):
-            return []
+            return [], None
         # else return original error
         raise ValueError(e)
+    else:
+        link = http_response.headers.get("Link")
+        if cache_key:
+            _http_cache.put(cache_key, body,
+                etag=http_response.headers.get("ETag"),
+                last_modified=http_response.headers.get("Last-Modified"),
+                link=link)
 
-    link = http_response.headers.get("Link")
     nexturl = _link2dict(link).get("next") if link else None
-    if nexturl:
-        response_body.extend(_query(nexturl, username, password, token, data))
-
-    return response_body
+    return response_body, nexturl
@@ -0,0 +1,201 @@
+"""
+HTTP transport with persistent (keep-alive) connections.
+
+urllib2.urlopen() opens a new connection, with a new TCP and TLS handshake,
+for every request. urlopen() here takes an idle connection to the host from
+a shared ConnectionPool instead, and puts it back once the response is read,
+so that the requests to GitHub and to the reviews server reuse a few
+connections. It is a drop-in replacement for urllib2.urlopen(): it takes a
+urllib2.Request, follows redirects, and raises urllib2.HTTPError for error
+responses and urllib2.URLError when the host cannot be reached.
+"""
+
+import httplib
+import os
+import socket
+import threading
+import urllib
+import urllib2
+from StringIO import StringIO
+from urlparse import urljoin
+
+user_agent = "Python-urllib/%s" % urllib2.__version__
+
+# Requests that can be sent again after a failure on a reused connection
+idempotent_methods = ("GET", "HEAD")
+
+
+def _closed_without_response(e):
+    """
+    Returns True if the exception 'e' of getresponse() means that the server
+    closed the connection before sending back anything.
+    """
+    # The message of the BadStatusLine differs between versions of Python 2.7
+    return isinstance(e, httplib.BadStatusLine) and (e.line in ("", "''") or
+        e.line.startswith("No status line received"))
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections, at most 'max_idle' per host, shared by all
+    threads.
+
+    More requests than that can run at the same time, on new connections,
+    but only 'max_idle' connections of a host are kept open afterwards.
+
+    A process forked from the one that made the pool (a worker of --jobs)
+    does not reuse the idle connections it inherited, as the parent and the
+    other workers use the same sockets.
+    """
+
+    max_redirections = 10
+
+    def __init__(self, max_idle=4, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """
+        Drops the idle connections inherited from the parent process, after a
+        fork. They are not closed, as they are still used by the parent.
+        """
+        if self._pid != os.getpid():
+            self._idle = {}
+            # It may have been held by another thread at the time of the fork
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def _get(self, key):
+        """
+        Returns a connection to 'key', a (scheme, host) tuple, and whether it
+        was used before.
+        """
+        self._check_fork()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host = key
+        if scheme == "https":
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        return connection_class(host, timeout=self.timeout), False
+
+    def _put(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self._check_fork()
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, method, url, data, headers):
+        """
+        Makes the request and returns the httplib.HTTPResponse and its body.
+        """
+        scheme, rest = urllib.splittype(url)
+        if scheme not in ("http", "https"):
+            raise urllib2.URLError("unknown url type: %s" % scheme)
+        host, selector = urllib.splithost(rest)
+        if not host:
+            raise urllib2.URLError("no host given")
+        key = (scheme, host)
+        idempotent = method in idempotent_methods
+        while True:
+            connection, reused = self._get(key)
+            sent = False
+            try:
+                connection.request(method, selector or "/", data, headers)
+                sent = True
+                response = connection.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException) as e:
+                connection.close()
+                # The server may have closed the idle connection in the
+                # meantime. Other requests are only sent again if the server
+                # cannot have processed them: they could not be sent, or the
+                # connection was closed without any response
+                if reused and (idempotent or not sent or
+                        _closed_without_response(e)):
+                    continue
+                raise urllib2.URLError(e)
+            if response.will_close:
+                connection.close()
+            else:
+                self._put(key, connection)
+            return response, body
+
+    def urlopen(self, request):
+        """
+        Makes the urllib2.Request (or URL) 'request' and returns the response
+        like urllib2.urlopen() does.
+        """
+        if isinstance(request, basestring):
+            request = urllib2.Request(request)
+        if urllib.getproxies().get(request.get_type()):
+            # Keep urllib2's handling of proxies
+            return urllib2.urlopen(request)
+        url = request.get_full_url()
+        method = request.get_method()
+        data = request.get_data()
+        headers = dict((name.title(), value)
+            for name, value in request.header_items())
+        headers.setdefault("User-Agent", user_agent)
+        if data is not None:
+            headers.setdefault("Content-Type",
+                "application/x-www-form-urlencoded")
+        redirections = 0
+        while True:
+            response, body = self._request(method, url, data, headers)
+            code = response.status
+            location = response.getheader("location") or \
+                response.getheader("uri")
+            if code in (301, 302, 303, 307) and location and \
+                    (method in ("GET", "HEAD") or
+                     (code != 307 and method == "POST")):
+                redirections += 1
+                if redirections > self.max_redirections:
+                    raise urllib2.HTTPError(url, code,
+                        "The HTTP server returned a redirect error that "
+                        "would lead to an infinite loop.\n"
+                        "The last 30x error message was:\n" + response.reason,
+                        response.msg, StringIO(body))
+                # Like urllib2, redirect POSTs to GETs of the new location
+                url = urljoin(url, location)
+                method = "GET" if method == "POST" else method
+                data = None
+                headers.pop("Content-Type", None)
+                continue
+            result = urllib.addinfourl(StringIO(body), response.msg, url,
+                code)
+            result.msg = response.reason
+            if not 200 <= code < 300:
+                raise urllib2.HTTPError(url, code, response.reason,
+                    response.msg, result)
+            return result
+
+
+pool = ConnectionPool()
+
+
+def urlopen(request):
+    """
+    Opens the urllib2.Request (or URL) 'request' with the shared
+    ConnectionPool, see ConnectionPool.urlopen().
+    """
+    return pool.urlopen(request)
@@ -0,0 +1,137 @@
+"""
+On-disk cache of the responses of the GitHub API.
+
+Responses are stored with their ETag and Last-Modified headers, and reused by
+sending them back in If-None-Match and If-Modified-Since: if the resource did
+not change, GitHub answers 304 Not Modified, with no body, and the request
+does not count against the rate limit. Every use of an entry revalidates it,
+so the cache never returns outdated data, it only saves the downloads and
+the rate limit.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from tempfile import mkstemp
+
+
+class HTTPCache(object):
+    """
+    Cached responses, one JSON file per URL and authentication in 'path'.
+
+    max_size ... maximum total size of the cache in bytes (None for no limit)
+    max_age .... time in seconds after which an entry that was not used
+    (revalidated) is dropped (None for no limit)
+
+    When the cache is over 'max_size', the least recently used entries are
+    evicted first. The modification time of an entry is the last time it was
+    used.
+    """
+
+    # evict() is called every 'evict_interval' put()s
+    evict_interval = 100
+
+    def __init__(self, path, max_size=None, max_age=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        self.max_age = max_age
+        self._puts = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def key(url, authorization=None):
+        """
+        Returns the key of 'url' requested with the Authorization header
+        'authorization', as responses depend on who asks for them.
+        """
+        parts = [url, authorization or ""]
+        parts = [p.encode("utf8") if isinstance(p, unicode) else p
+            for p in parts]
+        return hashlib.sha1("\0".join(parts)).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """
+        Returns the cached response for 'key' as a dict with the keys "body",
+        "etag", "last_modified" and "link" (the headers, None if the response
+        did not have them), or None if there is none.
+        """
+        entry = self._entry(key)
+        try:
+            if self.max_age is not None and \
+                    time.time() - os.path.getmtime(entry) > self.max_age:
+                return None
+            with open(entry) as f:
+                return json.load(f)
+        except (OSError, IOError, ValueError):
+            return None
+
+    def touch(self, key):
+        """
+        Marks the entry of 'key' as used, after it was revalidated.
+        """
+        try:
+            os.utime(self._entry(key), None)
+        except OSError:
+            pass
+
+    def put(self, key, body, etag=None, last_modified=None, link=None):
+        """
+        Stores the response 'body' (a str) with its headers under 'key', if
+        it can be revalidated (it has an ETag or a Last-Modified header).
+        """
+        if not etag and not last_modified:
+            return
+        fd, tmp = mkstemp(prefix="tmp-", dir=self.path)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"body": body.decode("utf8"), "etag": etag,
+                "last_modified": last_modified, "link": link}, f)
+        os.rename(tmp, self._entry(key))
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % self.evict_interval == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes entries that were not used for too long, then the least
+        recently used ones until the cache fits into max_size.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            try:
+                st = os.stat(entry)
+                if name.startswith("tmp-"):
+                    # Left over from an interrupted put(), unless it is new
+                    if now - st.st_mtime > 60*60:
+                        os.remove(entry)
+                    continue
+                if self.max_age is not None and \
+                        now - st.st_mtime > self.max_age:
+                    os.remove(entry)
+                    continue
+            except OSError:
+                # Removed by another thread or process
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+
+        if self.max_size is None:
+            return
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
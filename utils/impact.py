@@ -0,0 +1,136 @@
+"""
+Test impact selection.
+
+For every master commit, ImpactIndex maps the source files of sympy to the
+test functions that execute them (see trace_tests.py). The tests impacted by
+a pull request are then the ones that execute any of the files it changes,
+see select_tests(). They are run first, as a fast tier, before the full test
+suite.
+"""
+
+import json
+import os
+from tempfile import mkstemp
+
+from utils.cmd import cmd, cmd2, FileLock
+from utils.testrunner import create_worktree, remove_worktree
+
+trace_tests_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "trace_tests.py")
+# Changed when trace_tests.py changes what it maps, so that the maps it
+# computed before are not used
+map_version = 2
+
+
+def get_changed_files(repo_path, master_hash):
+    """
+    Returns the files that differ between 'master_hash' and the checkout at
+    'repo_path'.
+    """
+    output = cmd("git diff --name-only %s HEAD" % master_hash, capture=True,
+        cwd=repo_path)
+    return output.split()
+
+
+def is_test_file(path):
+    parts = path.split("/")
+    return "tests" in parts and parts[-1].startswith("test_") and \
+        parts[-1].endswith(".py")
+
+
+def select_tests(index, changed_files):
+    """
+    Returns the sorted list of test ids in 'index' that execute any of the
+    'changed_files'.
+
+    Changed test files are selected as a whole, as "path/to/test_file.py".
+    """
+    tests = set()
+    for path in changed_files:
+        if is_test_file(path):
+            tests.add(path)
+        tests.update(index.get(path, []))
+    return sorted(tests)
+
+
+def get_test_files(tests):
+    """
+    Returns the sorted list of test files of the test ids 'tests'.
+    """
+    return sorted(set(test.split("::")[0] for test in tests))
+
+
+class ImpactIndex(object):
+    """
+    Map of the source files of sympy to the tests that execute them, computed
+    at most once per master commit.
+
+    The maps are cached on disk in 'cache_dir', as one JSON file per master
+    commit. To compute them, master is checked out in a separate working tree
+    of 'master_repo_path' under 'workspace_base', and its tests are traced
+    with 'interpreter'.
+
+    At most 'max_commits' master commits are kept in the cache.
+    """
+
+    def __init__(self, cache_dir, master_repo_path, workspace_base,
+                 interpreter, max_commits=3):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.master_repo_path = master_repo_path
+        self.workspace_base = workspace_base
+        self.interpreter = interpreter
+        self.max_commits = max_commits
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get(self, master_hash):
+        """
+        Returns the map of 'master_hash', a dict mapping paths to lists of
+        test ids, or None if it could not be computed.
+        """
+        name = "%s-%d" % (master_hash, map_version)
+        filename = os.path.join(self.cache_dir, name + ".json")
+        if not os.path.isfile(filename):
+            with FileLock(os.path.join(self.cache_dir, name + ".lock")):
+                # Another review might have computed it in the meantime
+                if not os.path.isfile(filename):
+                    self._compute(master_hash, filename)
+        if not os.path.isfile(filename):
+            return None
+        # Mark as recently used
+        os.utime(filename, None)
+        with open(filename) as f:
+            return json.load(f)
+
+    def _compute(self, master_hash, filename):
+        workspace = os.path.join(self.workspace_base, "impact-%s" % master_hash)
+        create_worktree(self.master_repo_path, workspace, master_hash)
+        fd, tmp = mkstemp(dir=self.cache_dir)
+        os.close(fd)
+        try:
+            print "> Tracing the tests of master to find the tests impacted by each file"
+            log, r = cmd2("%s %s %s" % (self.interpreter, trace_tests_script,
+                tmp), cwd=workspace, echo=False)
+            if r == 0:
+                os.rename(tmp, filename)
+            else:
+                print "> WARNING: Could not trace the tests of master:"
+                print log.tail(2000).encode("utf8")
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            remove_worktree(self.master_repo_path, workspace)
+
+    def evict(self):
+        """
+        Removes the maps of all but the 'max_commits' most recently used
+        master commits.
+        """
+        maps = [os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+        maps = sorted((os.path.getmtime(m), m) for m in maps)
+        for _, filename in maps[:-self.max_commits]:
+            os.remove(filename)
+            lock = filename[:-len(".json")] + ".lock"
+            if os.path.exists(lock):
+                os.remove(lock)
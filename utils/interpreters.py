@@ -0,0 +1,150 @@
+"""
+Registry of the Python interpreters used to run the tests.
+
+Every interpreter is probed once, in a single subprocess, for its version,
+type and word size. The results are kept in memory and persisted to disk,
+keyed on the path, modification time and inode of the executable, so that
+an interpreter is only probed again when it is replaced.
+"""
+
+import json
+import os
+import subprocess
+import threading
+from tempfile import mkstemp
+
+default_registry_path = "~/.sympy/cache/interpreters.json"
+
+# Run by the interpreter being probed, with Python 2 or Python 3
+probe_code = """
+import sys
+if hasattr(sys, 'pypy_version_info'):
+    python_type = 'PyPy %s.%s.%s-%s-%s;' % sys.pypy_version_info[:]
+else:
+    python_type = 'Python'
+# Python 3 doesn't have maxint, 2.5 doesn't have maxsize
+maxsize = getattr(sys, 'maxint', None) or sys.maxsize
+print('%s.%s.%s-%s-%s' % sys.version_info[:])
+print(python_type)
+print(maxsize)
+"""
+
+
+def get_executable(interpreter):
+    path = os.environ['PATH']
+    paths = path.split(os.pathsep)
+    # Add .exe extension for Windows
+    if os.name == "nt":
+        interpreter = os.path.splitext(interpreter)[0] + ".exe"
+    if os.path.isfile(interpreter):
+        return interpreter
+    for p in paths:
+        f = os.path.join(p, interpreter)
+        if os.path.isfile(f):
+            return f
+
+
+def probe(interpreter):
+    """
+    Runs 'interpreter' once and returns a dict with its "python_version",
+    "python_type" and "maxsize" (None if it could not be run, in which case
+    "python_version" is its output).
+    """
+    p = subprocess.Popen("%s -" % interpreter, shell=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = p.communicate(probe_code)[0]
+    lines = output.strip().splitlines()
+    if p.returncode != 0 or len(lines) != 3:
+        return {"python_version": output.strip(), "python_type": "",
+            "maxsize": None}
+    return {"python_version": lines[0], "python_type": lines[1],
+        "maxsize": int(lines[2])}
+
+
+class InterpreterRegistry(object):
+    """
+    The probed interpreters (see probe()), persisted to the JSON file 'path'.
+    """
+
+    def __init__(self, path=default_registry_path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._interpreters = {}
+        self._lock = threading.Lock()
+
+    def get(self, interpreter):
+        """
+        Returns the probe() of 'interpreter', with its "executable".
+
+        The executable is looked up and stat()ed on every call, so that an
+        interpreter replaced while the daemon runs is probed again.
+        """
+        executable = get_executable(interpreter)
+        key = self._key(executable)
+        # Without an executable (for example an interpreter with options),
+        # it is only known by its name
+        memory_key = key or interpreter
+        with self._lock:
+            info = self._interpreters.get(memory_key)
+            if info is None:
+                info = self._lookup(interpreter, key)
+                if info["maxsize"] is not None:
+                    self._interpreters[memory_key] = info
+        return dict(info, executable=executable)
+
+    @staticmethod
+    def _key(executable):
+        """
+        Returns the key of 'executable', made of its real path, modification
+        time and inode, or None if it cannot be stat()ed.
+        """
+        if not executable:
+            return None
+        try:
+            # The executable is usually a symlink to the real one
+            st = os.stat(executable)
+        except OSError:
+            return None
+        return "%s:%s:%s" % (os.path.realpath(executable), int(st.st_mtime),
+            st.st_ino)
+
+    def _lookup(self, interpreter, key):
+        if key:
+            info = self._load().get(key)
+            if info:
+                return info
+        info = probe(interpreter)
+        if key and info["maxsize"] is not None:
+            self._save(key, info)
+        return info
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, key, info):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Other processes might have added interpreters in the meantime
+        interpreters = self._load()
+        interpreters[key] = info
+        fd, tmp = mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(interpreters, f)
+        os.rename(tmp, self.path)
+
+
+registry = InterpreterRegistry()
+
+
+def set_registry_path(path):
+    """
+    Persists the probed interpreters to the file 'path' instead of
+    'default_registry_path'.
+    """
+    global registry
+    registry = InterpreterRegistry(path)
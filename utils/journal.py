@@ -0,0 +1,100 @@
+"""
+Journal of a 'sympy-bot review' run, used to resume it after a crash.
+"""
+
+import json
+import os
+import time
+
+
+class RunJournal(object):
+    """
+    Append-only journal of the run 'run_id', in 'runs_dir'/<run_id>/journal.
+
+    Every line is a JSON event, written and synced to disk as soon as it
+    happens:
+
+    start ... the run (or a resumption of it) started, with the
+    "pr_numbers" to review, the "workspace" used and the "settings" that the
+    results of the stages depend on (a run is only resumed with the same)
+    stage ... a stage of the review of pull request "n" finished, with the
+    "branch_hash" and "master_hash" it was run for and its results
+    done .... the review of pull request "n" was commented
+
+    If 'run_id' is None, a new run is started. The directory of the run is
+    only created when the first event is recorded, so that looking up a run
+    that does not exist leaves nothing behind.
+    """
+
+    def __init__(self, runs_dir, run_id=None):
+        runs_dir = os.path.abspath(os.path.expanduser(runs_dir))
+        if run_id is None:
+            run_id = time.strftime("%Y%m%d-%H%M%S") + "-%d" % os.getpid()
+        self.run_id = run_id
+        self.run_dir = os.path.join(runs_dir, run_id)
+        self.path = os.path.join(self.run_dir, "journal")
+        self.events = self._load()
+
+    def _load(self):
+        events = []
+        self._cut_short = False
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # The last line was cut short by a crash
+                        pass
+                    self._cut_short = not line.endswith("\n")
+        except IOError:
+            pass
+        return events
+
+    def record(self, event, **data):
+        data["event"] = event
+        data["time"] = time.time()
+        # One write per event, to a file opened for appending, so that the
+        # reviews running in other processes do not mix up their lines
+        line = json.dumps(data) + "\n"
+        if self._cut_short:
+            line = "\n" + line
+            self._cut_short = False
+        if not os.path.isdir(self.run_dir):
+            os.makedirs(self.run_dir)
+        with open(self.path, "a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.events.append(data)
+
+    def get_start(self):
+        """
+        Returns the last "start" event, or None if the run never started.
+        """
+        starts = [e for e in self.events if e["event"] == "start"]
+        return starts[-1] if starts else None
+
+    def record_stage(self, n, stage, branch_hash, master_hash, **data):
+        self.record("stage", n=n, stage=stage, branch_hash=branch_hash,
+            master_hash=master_hash, **data)
+
+    def get_stage(self, n, stage, branch_hash, master_hash):
+        """
+        Returns the last "stage" event of 'stage' of pull request 'n', if it
+        was run for the same 'branch_hash' and 'master_hash', or None.
+        """
+        for e in reversed(self.events):
+            if (e["event"] == "stage" and e["n"] == n and
+                    e["stage"] == stage):
+                if (e["branch_hash"] == branch_hash and
+                        e["master_hash"] == master_hash):
+                    return e
+                return None
+        return None
+
+    def record_done(self, n):
+        self.record("done", n=n)
+
+    def is_done(self, n):
+        return any(e["event"] == "done" and e["n"] == n for e in self.events)
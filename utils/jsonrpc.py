@@ -1,12 +1,14 @@
 """Convenient interface to JSON RPC services. """
 
 from uuid import uuid4
-from urllib2 import urlopen, Request
+from urllib2 import Request
 try:
     from json import dumps, loads
 except ImportError:
     from simplejson import dumps, loads
 
+from utils.http import urlopen
+
 
 class JSONRPCError(Exception):
 
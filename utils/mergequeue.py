@@ -0,0 +1,101 @@
+"""
+Merge queue: tests many pull requests with a few runs of the test suite.
+
+The pull requests of a batch are all merged into master and the tests are run
+once. If they pass, every pull request of the batch passes. If they fail, the
+batch is split into halves, which are tested on top of the pull requests
+that passed so far, until the culprits are found (see bisect_batch()). With
+few failing pull requests, N pull requests are tested in about log N runs.
+"""
+
+from utils.cmd import cmd, cmd2, CmdException
+
+
+def fetch_pull_requests(repo_path, numbers):
+    """
+    Fetches the heads of the pull requests 'numbers' from origin (a mirror of
+    the GitHub repository, see update_mirror()) into 'test_<n>'.
+
+    Returns a dict mapping the numbers of the pull requests that could be
+    fetched to the hashes of their heads.
+    """
+    hashes = {}
+    for n in numbers:
+        try:
+            cmd("git fetch origin \"+refs/pull/%d/head:test_%d\"" % (n, n),
+                echo=True, cwd=repo_path)
+        except CmdException:
+            print "> Could not fetch pull request #%d" % n
+            continue
+        hashes[n] = cmd("git rev-parse test_%d" % n, capture=True,
+            cwd=repo_path).strip()
+    return hashes
+
+
+def merge_batch(repo_path, master_hash, numbers):
+    """
+    Checks out 'master_hash' at 'repo_path' and merges the pull requests
+    'numbers' (fetched by fetch_pull_requests()) into it, in order.
+
+    Returns None if they all merged, or the log of the merge that failed.
+    """
+    cmd("git reset --hard && git checkout --detach %s" % master_hash,
+        cwd=repo_path)
+    for n in numbers:
+        merge_log, r = cmd2("git merge --no-edit test_%d" % n, cwd=repo_path)
+        if r != 0:
+            # Also cleans up when the merge could not even start
+            cmd("git reset --hard", cwd=repo_path)
+            return "Merging #%d into the batch failed:\n%s" % (n,
+                merge_log.read())
+    return None
+
+
+def bisect_batch(numbers, test_batch):
+    """
+    Finds which of the pull requests 'numbers' pass their tests.
+
+    test_batch ... a function called with a list of pull request numbers,
+    running the tests of master with all of them merged (in order) and
+    returning the result as a dict with the key "result" (see run_tests(),
+    "conflicts" if they could not be merged)
+
+    A pull request passes if the tests pass with it merged together with the
+    pull requests that passed before it. Returns a dict mapping 'numbers' to
+    verdicts, dicts with the "result" of the run that decided it, that
+    result as "run", and the list of pull requests that were merged in that
+    run as "batch", and the number of runs of 'test_batch'.
+    """
+    verdicts = {}
+    runs = [0]
+
+    def _run(batch):
+        runs[0] += 1
+        print "> Merge queue run %d: testing %s" % (runs[0],
+            ", ".join("#%d" % n for n in batch))
+        result = test_batch(batch)
+        print "> Merge queue run %d: %s" % (runs[0], result["result"])
+        return result
+
+    def _process(accepted, batch, result=None):
+        # 'result' is that of accepted + batch, if it was already run
+        if result is None:
+            result = _run(accepted + batch)
+        if result["result"] == "Passed" or len(batch) == 1:
+            for n in batch:
+                verdicts[n] = {"result": result["result"], "run": result,
+                    "batch": accepted + batch}
+            if result["result"] == "Passed":
+                return accepted + batch
+            return accepted
+        left, right = batch[:len(batch)//2], batch[len(batch)//2:]
+        accepted_left = _process(accepted, left)
+        if accepted_left == accepted + left:
+            # The culprits are in the right half, which already failed on
+            # top of the left one
+            return _process(accepted_left, right, result)
+        return _process(accepted_left, right)
+
+    if numbers:
+        _process([], list(numbers))
+    return verdicts, runs[0]
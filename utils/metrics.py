@@ -0,0 +1,148 @@
+"""
+Timing of the phases of the reviews.
+
+The phases are timed with nested spans (see span() and traced()), which are
+written as JSON lines to the trace file of the run, set with configure().
+Each line has the "name" of the phase, its "id" and the "parent" id of the
+enclosing span (of the same thread), its "start" time and "duration" in
+seconds, whether it ended with an "error", and the attributes given to the
+span. Without a trace file, spans cost next to nothing.
+
+aggregate() summarizes the spans of many runs, see 'sympy-bot stats'.
+"""
+
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+_trace_path = None
+_write_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+def configure(path):
+    """
+    Writes the spans of this process (and of the processes it forks later)
+    to the trace file 'path'.
+    """
+    global _trace_path
+    path = os.path.abspath(os.path.expanduser(path))
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _trace_path = path
+
+
+def _write(record):
+    line = json.dumps(record) + "\n"
+    # One write per span, to a file opened for appending, so that spans of
+    # other processes writing to the same trace are not mixed up
+    with _write_lock:
+        with open(_trace_path, "a") as f:
+            f.write(line)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Times the body of a with statement as the phase 'name'.
+    """
+    if _trace_path is None:
+        yield
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    span_id = "%d-%d" % (os.getpid(), next(_ids))
+    parent = stack[-1] if stack else None
+    stack.append(span_id)
+    start = time.time()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        stack.pop()
+        record = dict(attrs)
+        record.update({"name": name, "id": span_id, "parent": parent,
+            "start": start, "duration": time.time() - start, "error": error})
+        _write(record)
+
+
+def traced(name, attrs=None):
+    """
+    Decorator timing every call of a function as the phase 'name'.
+
+    attrs ... a function called with the arguments of the call, returning
+    the attributes of the span
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _trace_path is None:
+                return f(*args, **kwargs)
+            span_attrs = attrs(*args, **kwargs) if attrs else {}
+            with span(name, **span_attrs):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_spans(traces_dir, last=None):
+    """
+    Returns the spans in the trace files in 'traces_dir', of the 'last' most
+    recent runs only if given.
+    """
+    traces_dir = os.path.abspath(os.path.expanduser(traces_dir))
+    paths = sorted(glob.glob(os.path.join(traces_dir, "*.jsonl")),
+        key=os.path.getmtime)
+    if last:
+        paths = paths[-last:]
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    # Cut short by a crash
+                    pass
+    return spans, len(paths)
+
+
+def percentile(values, p):
+    """
+    Returns the 'p'-th percentile of 'values' (nearest rank).
+    """
+    values = sorted(values)
+    rank = max(int(round(p/100.0*len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def aggregate(spans):
+    """
+    Returns a dict mapping the name of every phase to a dict with the
+    "count" of its spans, the "errors" among them, and the "p50", "p95" and
+    "total" of their durations.
+    """
+    durations = {}
+    errors = {}
+    for s in spans:
+        durations.setdefault(s["name"], []).append(s["duration"])
+        errors[s["name"]] = errors.get(s["name"], 0) + bool(s.get("error"))
+    stats = {}
+    for name, values in durations.iteritems():
+        stats[name] = {
+            "count": len(values),
+            "errors": errors[name],
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "total": sum(values),
+        }
+    return stats
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+from utils.cmd import CommandLog
+
+
+class ResultCache(object):
+    """
+    On-disk cache of test results.
+
+    Results are keyed on everything that determines them: the hashes of the
+    branch and of the master it is merged into, the interpreter (and its
+    version) and the test command, see ResultCache.key(). Each entry is a
+    directory under 'path' holding the status and upload URL in 'result.json'
+    and the log of the run in 'log'.
+
+    max_size ... maximum total size of the cache in bytes (None for no limit)
+    max_age .... maximum age of an entry in seconds (None for no limit)
+
+    When the cache is over 'max_size', the least recently used entries are
+    evicted first.
+    """
+
+    def __init__(self, path, max_size=None, max_age=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        self.max_age = max_age
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def key(branch_hash, master_hash, interpreter, interpreter_version,
+            test_command):
+        parts = [branch_hash, master_hash, interpreter, interpreter_version,
+            test_command]
+        parts = [p.encode("utf8") if isinstance(p, unicode) else p
+            for p in parts]
+        return hashlib.sha1("\0".join(parts)).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        """
+        Returns True if there is a result for 'key', without marking it as
+        recently used.
+        """
+        try:
+            with open(os.path.join(self._entry(key), "result.json")) as f:
+                created = json.load(f)["time"]
+        except (IOError, ValueError, KeyError):
+            return False
+        return self.max_age is None or time.time() - created <= self.max_age
+
+    def get(self, key):
+        """
+        Returns the cached result for 'key' as a dict with the keys "result",
+        "url" and "log" (a CommandLog), or None if there is none.
+
+        The "url" is None if the result was not uploaded.
+        """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, "result.json")) as f:
+                result = json.load(f)
+            if self.max_age is not None and \
+                    time.time() - result["time"] > self.max_age:
+                return None
+            result["log"] = CommandLog.from_file(os.path.join(entry, "log"))
+        except (IOError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(entry, None)
+        return result
+
+    def put(self, key, result, log, url=None):
+        """
+        Stores the status 'result' and the 'log' (a CommandLog) of a run under
+        'key'.
+
+        url ... the URL of the uploaded report, if it was uploaded
+        """
+        tmp = mkdtemp(prefix="tmp-", dir=self.path)
+        with open(os.path.join(tmp, "result.json"), "w") as f:
+            json.dump({"result": result, "url": url, "time": time.time()}, f)
+        log.save(os.path.join(tmp, "log"))
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+
+    def set_url(self, key, url):
+        """
+        Records the URL of the uploaded report of an existing entry.
+        """
+        filename = os.path.join(self._entry(key), "result.json")
+        with open(filename) as f:
+            result = json.load(f)
+        result["url"] = url
+        with open(filename, "w") as f:
+            json.dump(result, f)
+
+    def evict(self):
+        """
+        Removes entries that are too old, then the least recently used ones
+        until the cache fits into max_size.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if not os.path.isdir(entry):
+                continue
+            if name.startswith("tmp-"):
+                # Left over from an interrupted put(), unless it is very new
+                if now - os.path.getmtime(entry) > 24*60*60:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            mtime = os.path.getmtime(entry)
+            if self.max_age is not None:
+                try:
+                    with open(os.path.join(entry, "result.json")) as f:
+                        created = json.load(f)["time"]
+                except (IOError, ValueError, KeyError):
+                    created = 0
+                if now - created > self.max_age:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    continue
+            size = sum(os.path.getsize(os.path.join(entry, f))
+                for f in os.listdir(entry))
+            entries.append((mtime, size, entry))
+
+        if self.max_size is None:
+            return
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
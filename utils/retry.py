@@ -0,0 +1,213 @@
+"""
+Retrying of calls to remote services (GitHub, the reviews server).
+
+Failed calls are retried after a capped exponential backoff with full
+jitter, so that the workers of a run do not all retry at the same moment.
+Every endpoint (host) has a CircuitBreaker shared by all the threads of the
+process: after 'failure_threshold' consecutive failures it opens, and calls
+to that endpoint wait until it is tried again, instead of each worker
+hammering a service that is down.
+"""
+
+import random
+import sys
+import threading
+import time
+import urllib2
+from urlparse import urlparse
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when the circuit breaker of an endpoint stays open past the
+    deadline of a call.
+    """
+    pass
+
+
+class RetryPolicy(object):
+    """
+    How calls are retried.
+
+    initial_delay ... the backoff before the first retry, in seconds
+    max_delay ....... the maximum backoff
+    deadline ........ time after which a call gives up and raises its last
+    error, None to retry forever
+
+    The backoff doubles with every retry, up to 'max_delay', and the actual
+    delay is drawn uniformly between 0 and the backoff (full jitter).
+    """
+
+    def __init__(self, initial_delay=1, max_delay=5*60, deadline=None):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt):
+        return min(self.initial_delay*2**min(attempt, 32), self.max_delay)
+
+    def delay(self, attempt):
+        return random.uniform(0, self.backoff(attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of the endpoint 'name'.
+
+    It opens after 'failure_threshold' consecutive failures. After
+    'reset_timeout' seconds, a single call is let through (half open): if it
+    succeeds the breaker closes, otherwise it opens again. If that call ends
+    without either (it was interrupted), another one is let through after
+    'reset_timeout' seconds.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = None
+        self.trial = False
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns 0 if a call may go ahead, or the number of seconds to wait
+        before asking again.
+        """
+        with self._lock:
+            if self.open_until is None:
+                return 0
+            now = time.time()
+            if now < self.open_until:
+                return self.open_until - now
+            if self.trial and now - self.trial_started < self.reset_timeout:
+                # Another call is finding out if the endpoint is back
+                return 1
+            self.trial = True
+            self.trial_started = now
+            print "> Circuit breaker of %s is half open, trying again" % self.name
+            return 0
+
+    def record_success(self):
+        with self._lock:
+            if self.open_until is not None:
+                print "> Circuit breaker of %s closed" % self.name
+            self.failures = 0
+            self.open_until = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.open_until is None and
+                    self.failures >= self.failure_threshold):
+                print "> Circuit breaker of %s open after %d consecutive failures, pausing calls for %d seconds" % (
+                    self.name, self.failures, self.reset_timeout)
+                self.open_until = time.time() + self.reset_timeout
+                self.trial = False
+
+
+default_policy = RetryPolicy()
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def set_default_policy(policy):
+    global default_policy
+    default_policy = policy
+
+
+def get_breaker(endpoint):
+    """
+    Returns the CircuitBreaker of 'endpoint', a URL or a host name.
+    """
+    name = urlparse(endpoint).netloc or endpoint
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def is_transient_http_error(e):
+    """
+    Returns False for the HTTP errors that will not go away by retrying
+    (client errors other than rate limiting), True for other URLErrors.
+    """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code >= 500 or e.code in (403, 408, 429)
+    return True
+
+
+def retry(command, errors, what_did, endpoint=None, on_except=None,
+          is_transient=None, policy=None):
+    """
+    Calls 'command' until it does not raise one of 'errors'.
+
+    what_did ....... what 'command' does, for the messages, in the form
+    "get pull request 1234"
+    endpoint ....... URL (or host) called by 'command', whose CircuitBreaker
+    is used
+    on_except ...... a function called with each error caught; if it returns
+    a value other than None, that value is returned
+    is_transient ... a function called with each error caught, returning
+    False if retrying is pointless, in which case the error is raised
+    policy ......... the RetryPolicy, 'default_policy' if None
+
+    Returns the return value of 'command'. When the deadline of the policy
+    is reached, the last error is raised (CircuitOpenError if the breaker of
+    the endpoint never let the call through).
+    """
+    policy = policy or default_policy
+    if policy.deadline:
+        deadline = time.time() + policy.deadline
+    else:
+        deadline = None
+    breaker = get_breaker(endpoint) if endpoint else None
+    attempt = 0
+    while True:
+        if breaker:
+            wait = breaker.acquire()
+            if wait:
+                if deadline and time.time() + wait > deadline:
+                    raise CircuitOpenError("Could not %s, %s is not "
+                        "responding" % (what_did, breaker.name))
+                time.sleep(wait)
+                continue
+        try:
+            return_value = command()
+        except errors as e:
+            # on_except() might catch other errors, replacing sys.exc_info()
+            exc_info = sys.exc_info()
+            transient = is_transient is None or is_transient(e)
+            if breaker:
+                if transient:
+                    breaker.record_failure()
+                else:
+                    # The endpoint answered
+                    breaker.record_success()
+            if on_except:
+                a = on_except(e)
+                if a is not None:
+                    return a
+            if not transient:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            delay = policy.delay(attempt)
+            attempt += 1
+            if deadline and time.time() + delay > deadline:
+                print "Could not %s, giving up after %d attempts" % (what_did,
+                    attempt)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            print "Could not %s, retrying in %d seconds..." % (what_did,
+                delay)
+            time.sleep(delay)
+        except Exception:
+            # Not a failure of the endpoint, which answered
+            if breaker:
+                breaker.record_success()
+            raise
+        else:
+            if breaker:
+                breaker.record_success()
+            return return_value
@@ -3,7 +3,9 @@ import urllib2
 from jsonrpc import JSONRPCService
 from urllib import urlencode
 
-from utils.cmd import keep_trying
+from utils.http import urlopen
+from utils.metrics import traced
+from utils.retry import retry, is_transient_http_error
 
 def reviews_pastehtml_upload(source, input_type="html"):
     """
@@ -16,7 +18,9 @@ def reviews_pastehtml_upload(source, input_type="html"):
     url = "http://pastehtml.com/upload/create?input_type=%s&result=address"
     request = urllib2.Request(url % input_type, data=urlencode([("txt", source)]))
 
-    result = keep_trying(lambda: urllib2.urlopen(request), urllib2.URLError, "access pastehtml.com")
+    result = retry(lambda: urlopen(request), urllib2.URLError,
+        "access pastehtml.com", endpoint=url,
+        is_transient=is_transient_http_error)
 
     s = result.read()
     # There is a bug at pastehtml.com, that sometimes it returns:
@@ -29,6 +33,7 @@ def reviews_pastehtml_upload(source, input_type="html"):
     return s
 
 
+@traced("upload")
 def reviews_sympy_org_upload(data, url_base):
     def _do_upload():
         s = JSONRPCService(url_base + "/async")
@@ -48,7 +53,8 @@ def reviews_sympy_org_upload(data, url_base):
         if e.message == "Quota":
             print "Server appears to be over quota."
 
-    r = keep_trying(_do_upload, urllib2.URLError, "access %s" %
-                    url_base, _handler)
+    r = retry(_do_upload, urllib2.URLError, "access %s" % url_base,
+        endpoint=url_base, on_except=_handler,
+        is_transient=is_transient_http_error)
 
     return r["task_url"]
@@ -0,0 +1,150 @@
+"""
+Order in which pull requests are reviewed.
+
+When many pull requests are reviewed (``sympy-bot review all``), the ones
+that were pushed to recently and that are quick to review should not wait
+behind old ones that take the full test suite. schedule() orders them by
+weighted shortest job first: the value of a review divided by its predicted
+run time, where
+
+- the value decreases with the time since the pull request was last updated
+  and is lower for pull requests that cannot be merged,
+- the run time is predicted from the durations of earlier reviews, recorded
+  in a RunHistory, and is short when the results are already cached or the
+  pull request cannot be merged (then only the conflicts are reported).
+"""
+
+import heapq
+import json
+import os
+import time
+
+# Predicted run time of a review when there is no history at all, in seconds
+default_runtime = 60*60
+# ... and of a review that does not run the tests
+default_cheap_runtime = 60
+# Time since the last update after which the value of a review is halved
+half_value_age = 7*24*60*60
+# Value of a review of a pull request that cannot be merged, relative to one
+# that can
+nonmergeable_value = 0.5
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values)//2]
+
+
+class RunHistory(object):
+    """
+    Durations of earlier reviews, appended as JSON lines to the file 'path'.
+
+    Each line records the pull request number "n", the "branch_hash", the
+    "kind" of review ("tested", "cached", "conflicts" or "fetch"), its
+    "duration" in seconds and the "time" it finished. Only the last
+    'max_entries' lines are used for predictions.
+    """
+
+    cheap_kinds = {"cached", "conflicts", "fetch"}
+
+    def __init__(self, path, max_entries=1000):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_entries = max_entries
+        self._entries = None
+
+    def record(self, n, branch_hash, kind, duration):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        line = json.dumps({"n": n, "branch_hash": branch_hash, "kind": kind,
+            "duration": duration, "time": time.time()})
+        # A single small write to a file opened for appending is atomic, so
+        # concurrent reviews do not mix up their lines
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+        self._entries = None
+
+    def entries(self):
+        if self._entries is None:
+            entries = []
+            try:
+                with open(self.path) as f:
+                    for line in f:
+                        try:
+                            entries.append(json.loads(line))
+                        except ValueError:
+                            # Cut short by an interrupted write
+                            pass
+            except IOError:
+                pass
+            self._entries = entries[-self.max_entries:]
+        return self._entries
+
+    def predict(self, n, cheap=False):
+        """
+        Returns the predicted duration of a review of pull request 'n'.
+
+        cheap ... True if the review will not run the tests (the results are
+        cached, or the pull request cannot be merged)
+        """
+        entries = self.entries()
+        if cheap:
+            durations = [e["duration"] for e in entries
+                if e["kind"] in self.cheap_kinds]
+            return _median(durations[-50:]) or default_cheap_runtime
+        tested = [e for e in entries if e["kind"] == "tested"]
+        own = [e["duration"] for e in tested if e["n"] == n]
+        if own:
+            return own[-1]
+        return _median([e["duration"] for e in tested][-50:]) or \
+            default_runtime
+
+
+class Job(object):
+    """
+    Planned review of a pull request, see schedule().
+    """
+
+    def __init__(self, pull, predicted, cached, priority):
+        self.n = pull["n"]
+        self.pull = pull
+        self.predicted = predicted
+        self.cached = cached
+        self.priority = priority
+        self.start = None
+        self.end = None
+
+
+def schedule(pulls, history, workers=1, cached=(), now=None):
+    """
+    Plans the reviews of 'pulls' (see github_get_pull_request_infos()).
+
+    workers ... number of pull requests reviewed at the same time
+    cached .... numbers of the pull requests whose results are all cached
+
+    Returns the list of Jobs in the order they should be reviewed, with their
+    predicted "start" and "end" times (in seconds from 'now').
+    """
+    if now is None:
+        now = time.time()
+    jobs = []
+    for pull in pulls:
+        mergeable = pull["mergeable"] is not False
+        is_cached = pull["n"] in cached
+        predicted = history.predict(pull["n"], cheap=is_cached or not mergeable)
+        age = max(now - pull["updated_at"], 0)
+        value = 0.5**(float(age)/half_value_age)
+        if not mergeable:
+            value *= nonmergeable_value
+        jobs.append(Job(pull, predicted, is_cached, value/max(predicted, 1)))
+    jobs.sort(key=lambda job: (-job.priority, job.n))
+
+    # Each job goes to the worker that is free first
+    free_at = [0]*max(workers, 1)
+    for job in jobs:
+        job.start = heapq.heappop(free_at)
+        job.end = job.start + job.predicted
+        heapq.heappush(free_at, job.end)
+    return jobs
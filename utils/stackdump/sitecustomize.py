@@ -0,0 +1,22 @@
+"""
+Dumps the stacks of all threads to stderr on SIGQUIT (sent by the watchdog
+of cmd2() before it kills a command that timed out) and on SIGXCPU (sent
+when the CPU time limit is reached).
+
+This directory is put on the PYTHONPATH of the commands run by cmd2() with
+limits, so this file is imported by every Python process they start (instead
+of any other sitecustomize module). It has to work with all the interpreters
+under test. faulthandler is part of the
+standard library since Python 3.3, and is available for older versions from
+PyPI.
+"""
+
+try:
+    import faulthandler
+except ImportError:
+    pass
+else:
+    import signal
+    faulthandler.register(signal.SIGQUIT, all_threads=True)
+    if hasattr(signal, "SIGXCPU"):
+        faulthandler.register(signal.SIGXCPU, all_threads=True)
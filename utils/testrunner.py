@@ -1,11 +1,15 @@
 import os
-import re
+import shutil
+import subprocess
+from multiprocessing.pool import ThreadPool
 
-from utils.cmd import cmd, cmd2, CmdException
+from utils.cmd import (cmd, cmd2, CmdException, CommandLog,
+    wait_for_commands)
 
 
 def run_tests(pull_request_repo_url, pull_request_branch, master_repo_path,
-              test_command, master_commit):
+              test_command, master_commit, echo=True, abort=None,
+              limits=None):
     """
     This is a test runner function.
 
@@ -20,39 +24,149 @@ def run_tests(pull_request_repo_url, pull_request_branch, master_repo_path,
 
     3) saves report and logs into the out/ directory.
 
-    4) Returns status, which is one of the following strings:
+    4) Returns the result as a dict with the "log" (a CommandLog), the
+    "xpassed" and "failures" tests parsed from it, the "return_code" and the
+    "result", which is one of the following strings:
 
         error .. there was an error
         fetch ... fetch failed (no tests run)
         conflicts ... there were merge conflicts (no tests run)
         FAILED ... tests run, but failed
         PASSED ... tests run, passed
+        Skipped ... killed because 'abort' was set (see cmd2())
+        Timeout ... killed because it exceeded a timeout of 'limits' (see
+        RunLimits)
 
     """
+    log, r = cmd2(test_command, cwd=master_repo_path, echo=echo, abort=abort,
+        limits=limits)
     result = {
-        "log": "",
-        "xpassed": "",
+        "log": log,
+        "return_code": r,
+        "xpassed": log.xpassed,
+        "failures": log.failures,
     }
-    log, r = cmd2(test_command, cwd=master_repo_path)
-    result["log"] = log
-    result["return_code"] = r
-
-    result["xpassed"] = get_xpassed_info_from_log(log)
     print "Return code: ", r
     if r == 0:
         result["result"] = "Passed"
+    elif r is None:
+        result["result"] = "Timeout"
+    elif abort is not None and abort.is_set() and r < 0:
+        result["result"] = "Skipped"
     else:
         result["result"] = "Failed"
     return result
 
 
+def run_tests_parallel(pull_request_repo_url, pull_request_branch,
+                       master_repo_paths, test_commands, master_commit,
+                       abort=None, limits=None):
+    """
+    Runs each of 'test_commands' in the corresponding directory of
+    'master_repo_paths', all at the same time.
+
+    The output is not mirrored on the screen, it is only captured in the
+    logs. Returns the list of results (see run_tests()) in the same order as
+    'test_commands'.
+
+    abort ... a threading.Event, set as soon as one of the commands fails or
+    times out, which kills the others (see cmd2())
+    limits ... the RunLimits of each command
+    """
+    def _run(args):
+        path, test_command = args
+        result = run_tests(pull_request_repo_url, pull_request_branch, path,
+            test_command, master_commit, echo=False, abort=abort,
+            limits=limits)
+        print "> Finished '%s': %s" % (test_command, result["result"])
+        if abort is not None and result["result"] in ("Failed", "Timeout"):
+            abort.set()
+        return result
+
+    pool = ThreadPool(len(test_commands))
+    try:
+        return wait_for_commands(pool.map_async(_run, zip(master_repo_paths,
+            test_commands)))
+    finally:
+        pool.terminate()
+
+
+def run_tests_sharded(pull_request_repo_url, pull_request_branch,
+                      master_repo_path, stages, master_commit,
+                      abort=None, limits=None):
+    """
+    Runs the shards of a test suite in 'master_repo_path', and merges their
+    results into one (see run_tests()).
+
+    stages ... list of lists of shards (test commands): the shards of a
+    stage run at the same time, and the stages one after the other
+
+    The log is the concatenation of the logs of the shards, and the tests
+    passed only if all shards passed. With 'abort' (see
+    run_tests_parallel()), the first failing shard kills the others, and the
+    remaining stages are not run.
+    """
+    test_commands = []
+    results = []
+    for stage in stages:
+        if abort is not None and abort.is_set():
+            break
+        test_commands += stage
+        results += run_tests_parallel(pull_request_repo_url,
+            pull_request_branch, [master_repo_path]*len(stage), stage,
+            master_commit, abort=abort, limits=limits)
+
+    log = CommandLog()
+    for test_command, result in zip(test_commands, results):
+        log.write("\n==== Shard '%s' (return code %s) ====\n\n" % (
+            test_command, result["return_code"]))
+        result["log"].copy_to(log)
+        log.close()
+    # The return code of the first failing shard, rather than of a shard
+    # killed because of it
+    return_codes = [shard["return_code"] for shard in results
+        if shard["result"] in ("Failed", "Timeout")]
+    return_codes += [shard["return_code"] for shard in results]
+    r = ([c for c in return_codes if c != 0] or [0])[0]
+
+    result = {
+        "log": log,
+        "return_code": r,
+        "xpassed": log.xpassed,
+        "failures": log.failures,
+    }
+    statuses = [shard["result"] for shard in results]
+    if "Failed" in statuses:
+        result["result"] = "Failed"
+    elif "Timeout" in statuses:
+        result["result"] = "Timeout"
+    elif "Skipped" in statuses:
+        result["result"] = "Skipped"
+    else:
+        result["result"] = "Passed"
+    return result
+
+
+def copy_workspace(master_repo_path, workspace_path):
+    """
+    Copies the checked out tree at 'master_repo_path' (including the git
+    metadata) to 'workspace_path', replacing anything that is there.
+    """
+    if os.path.exists(workspace_path):
+        shutil.rmtree(workspace_path)
+    shutil.copytree(master_repo_path, workspace_path, symlinks=True)
+
+
 def get_xpassed_info_from_log(log):
-    re_xpassed = re.compile("\s+_+\s+xpassed tests\s+_+\s+(?P<xpassed>([^\n]+\n)+)\n", re.M)
-    m = re_xpassed.search(log)
-    if m:
-        lines = m.group('xpassed')
-        return lines.splitlines()
-    return []
+    """
+    Returns the xpassed tests of 'log', the text of a test run or a
+    CommandLog (possibly the merged log of several shards).
+
+    The xpassed tests of a run are parsed as it is written, see CommandLog.
+    """
+    if not isinstance(log, CommandLog):
+        log = CommandLog.from_text(log)
+    return log.xpassed
 
 
 def get_hashes(master_repo_path, master_commit, pull_request_number):
@@ -70,12 +184,16 @@ def get_hashes(master_repo_path, master_commit, pull_request_number):
 
 def fetch_branch(pull_request_repo_url, pull_request_branch, master_repo_path,
                  pull_request_number):
+    """
+    Fetches the branch into 'test_<pull_request_number>' and checks it out.
 
+    Origin is not fetched here, it is expected to be up to date (see
+    update_mirror()).
+    """
     try:
-        cmd("git fetch %s \"%s:test_%s\"" % (pull_request_repo_url,
+        cmd("git fetch %s \"+%s:test_%s\"" % (pull_request_repo_url,
             pull_request_branch, pull_request_number), echo=True,
             cwd=master_repo_path)
-        cmd("git fetch origin", echo=True, cwd=master_repo_path)
     except CmdException:
         return "fetch"
     cmd("git checkout test_%s" % pull_request_number, echo=True, cwd=master_repo_path)
@@ -93,6 +211,173 @@ def merge_branch(master_repo_path, master_commit):
         conflicts = cmd("git --no-pager diff", capture=True,
                 cwd=master_repo_path)
         result["result"] = "conflicts"
-        result["log"] = merge_log + "\nLIST OF CONFLICTS\n" + conflicts
-        cmd("git merge --abort && git checkout master", cwd=master_repo_path)
+        result["log"] = (merge_log.read() + "\nLIST OF CONFLICTS\n" +
+            conflicts)
+        # Detach, as master might be checked out in another working tree
+        cmd("git merge --abort && git checkout --detach master",
+                cwd=master_repo_path)
     return result
+
+
+def get_pull_request_heads(mirror_path):
+    """
+    Returns a dict mapping the numbers of the pull requests to the hashes of
+    their heads, as fetched into the mirror at 'mirror_path' (GitHub
+    publishes them as refs/pull/<n>/head, which the mirror fetches along
+    with the branches).
+    """
+    output = cmd("git for-each-ref --format=\"%(objectname) %(refname)\" "
+        "refs/pull/", capture=True, cwd=mirror_path)
+    heads = {}
+    for line in output.splitlines():
+        sha, ref = line.split()
+        parts = ref.split("/")
+        if len(parts) == 4 and parts[3] == "head" and parts[2].isdigit():
+            heads[int(parts[2])] = sha
+    return heads
+
+
+def precheck_merges(master_repo_path, mirror_path, merge_commits):
+    """
+    Finds out which pull requests conflict with the commit they are merged
+    with, without checking anything out.
+
+    merge_commits ... a dict mapping the numbers of the pull requests to the
+    commit each one is merged with (in the repository at 'master_repo_path',
+    which must share the objects of the mirror at 'mirror_path', see
+    clone_from_mirror())
+
+    Each merge is done on the object store only, with 'git merge-tree
+    --write-tree' (git 2.38 or later). Returns a dict mapping the numbers of
+    the pull requests found in the mirror to dicts with the keys 'result'
+    ("" or "conflicts", as merge_branch()), 'log', 'branch_hash',
+    'master_hash' and 'merge_commit', or None if git cannot do such merges.
+    """
+    heads = get_pull_request_heads(mirror_path)
+    master_hashes = {}
+    results = {}
+    for n, merge_commit in sorted(merge_commits.iteritems()):
+        if n not in heads:
+            continue
+        if merge_commit not in master_hashes:
+            master_hashes[merge_commit] = cmd("git rev-parse %s" %
+                merge_commit, capture=True, cwd=master_repo_path).strip()
+        master_hash = master_hashes[merge_commit]
+        branch_hash = heads[n]
+        p = subprocess.Popen(["git", "merge-tree", "--write-tree",
+            "--name-only", branch_hash, master_hash], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, cwd=master_repo_path)
+        output = p.communicate()[0].decode("utf8", "replace")
+        if p.returncode not in (0, 1):
+            # Usage error of an older git, or a missing commit
+            if not results:
+                print "> Cannot precheck the merges: %s" % output.strip()
+                return None
+            continue
+        result = {
+            "result": "",
+            "log": "",
+            "branch_hash": branch_hash,
+            "master_hash": master_hash,
+            "merge_commit": merge_commit,
+        }
+        if p.returncode == 1:
+            # The output is the merged tree, the conflicted files, an empty
+            # line and the messages of the merge
+            tree, rest = output.split("\n", 1)
+            files, _, messages = rest.partition("\n\n")
+            # The merged tree has the conflict markers, like the working
+            # tree after a failed 'git merge'
+            conflicts = cmd("git --no-pager diff %s %s -- %s" % (master_hash,
+                tree, " ".join("\"%s\"" % f for f in files.split("\n"))),
+                capture=True, cwd=master_repo_path)
+            result["result"] = "conflicts"
+            result["log"] = (messages + "\nLIST OF CONFLICTS\n" + files +
+                "\n\n" + conflicts)
+        results[n] = result
+    return results
+
+
+def update_mirror(repository_url, mirror_path, reference=None):
+    """
+    Creates or updates a bare mirror of 'repository_url' at 'mirror_path'.
+
+    The mirror is kept between runs, so only new objects are downloaded from
+    'repository_url'. Working copies are then cloned from the mirror (see
+    clone_from_mirror()). If 'reference' is given, it is kept as an alternate
+    object store of the mirror (see add_alternate()): objects are borrowed
+    from that local repository, and its commits that are not in
+    'repository_url' can be merged.
+    """
+    if os.path.isdir(mirror_path):
+        print "> Updating mirror %s" % mirror_path
+        if reference:
+            add_alternate(mirror_path, reference)
+        cmd("git remote set-url origin %s" % repository_url, cwd=mirror_path)
+        cmd("git fetch --prune origin", echo=True, cwd=mirror_path)
+        return
+
+    print "> Creating mirror %s" % mirror_path
+    mirror_dir = os.path.dirname(mirror_path)
+    if not os.path.isdir(mirror_dir):
+        os.makedirs(mirror_dir)
+    if reference:
+        cmd("git clone --mirror --reference \"%s\" %s \"%s\"" %
+            (reference, repository_url, mirror_path), echo=True)
+    else:
+        cmd("git clone --mirror %s \"%s\"" % (repository_url, mirror_path),
+            echo=True)
+
+
+def add_alternate(repo_path, reference):
+    """
+    Makes the bare repository at 'repo_path' use the objects of the local
+    repository 'reference', if it does not already.
+
+    The objects of 'reference' are not copied, so it must not be removed
+    while 'repo_path' uses it.
+    """
+    git_dir = cmd("git rev-parse --git-dir", capture=True,
+        cwd=reference).strip()
+    objects = os.path.join(os.path.abspath(reference), git_dir, "objects")
+    objects = os.path.normpath(objects)
+    alternates = os.path.join(repo_path, "objects", "info", "alternates")
+    if os.path.exists(alternates):
+        with open(alternates) as f:
+            if objects in f.read().splitlines():
+                return
+    with open(alternates, "a") as f:
+        f.write(objects + "\n")
+
+
+def clone_from_mirror(mirror_path, master_repo_path):
+    """
+    Clones the mirror at 'mirror_path' to 'master_repo_path'.
+
+    The clone borrows the objects of the mirror instead of copying them, so it
+    only takes a few seconds. Its origin is the mirror, so origin/master is
+    the master of the mirrored repository.
+    """
+    cmd("git clone --shared \"%s\" \"%s\"" % (mirror_path, master_repo_path),
+        echo=True)
+
+
+def create_worktree(master_repo_path, worktree_path, commit="master"):
+    """
+    Creates a new working tree at 'worktree_path', checked out at 'commit'.
+
+    The working tree shares the object store and the refs of the repository
+    at 'master_repo_path', so creating it is cheap and branches fetched into
+    it are visible everywhere. Each working tree has its own HEAD and index,
+    so several pull requests can be checked out and merged at the same time.
+    """
+    cmd("git worktree add --detach \"%s\" %s" % (worktree_path, commit),
+            echo=True, cwd=master_repo_path)
+
+
+def remove_worktree(master_repo_path, worktree_path):
+    """
+    Removes a working tree created by create_worktree().
+    """
+    cmd("git worktree remove --force \"%s\"" % worktree_path, echo=True,
+            cwd=master_repo_path)
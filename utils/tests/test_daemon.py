@@ -0,0 +1,146 @@
+"""
+Tests of the review daemon, with a local webhook endpoint and a stub review.
+
+Run them with:
+
+    python -m unittest discover utils/tests
+"""
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import unittest
+import urllib2
+
+from utils.daemon import Poller, ReviewDaemon
+from utils.url_templates import URLs
+
+secret = "webhook secret"
+
+
+class StubReview(object):
+    """
+    Records the reviewed pull requests. Each review waits until 'gate' is
+    set, so that events can be sent while it is running.
+    """
+
+    def __init__(self):
+        self.reviewed = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, n):
+        with self._lock:
+            self.reviewed.append(n)
+        self.started.set()
+        self.gate.wait(10)
+
+
+class TestReviewDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.review = StubReview()
+        self.daemon = ReviewDaemon(self.review, URLs(),
+            address=("127.0.0.1", 0), workers=1, secret=secret)
+        self.daemon.start()
+        host, port = self.daemon.server.server_address
+        self.url = "http://%s:%d/" % (host, port)
+
+    def tearDown(self):
+        self.review.gate.set()
+        self.daemon.shutdown()
+
+    def post(self, n, action="synchronize", signature=True):
+        """
+        Sends a pull_request event, and returns the HTTP status code.
+        """
+        body = json.dumps({"action": action, "number": n})
+        request = urllib2.Request(self.url, body)
+        request.add_header("Content-Type", "application/json")
+        request.add_header("X-GitHub-Event", "pull_request")
+        if signature is True:
+            signature = "sha1=" + hmac.new(secret, body,
+                hashlib.sha1).hexdigest()
+        if signature:
+            request.add_header("X-Hub-Signature", signature)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            return e.code
+        response.read()
+        return response.code
+
+    def wait_for_reviews(self, count):
+        deadline = time.time() + 10
+        while len(self.review.reviewed) < count and time.time() < deadline:
+            time.sleep(0.05)
+        # Any extra review would start right away
+        time.sleep(0.2)
+
+    def test_rejects_bad_signatures(self):
+        self.assertEqual(self.post(1, signature=None), 403)
+        self.assertEqual(self.post(1, signature="sha1=0123"), 403)
+        self.review.gate.set()
+        time.sleep(0.2)
+        self.assertEqual(self.review.reviewed, [])
+
+    def test_ignores_other_actions(self):
+        self.assertEqual(self.post(1, action="closed"), 202)
+        self.review.gate.set()
+        time.sleep(0.2)
+        self.assertEqual(self.review.reviewed, [])
+
+    def test_collapses_duplicates(self):
+        self.assertEqual(self.post(1), 202)
+        self.assertTrue(self.review.started.wait(10))
+        # Queued while #1 is reviewed, three times
+        for i in range(3):
+            self.assertEqual(self.post(2), 202)
+        self.assertEqual(len(self.daemon.job_queue), 1)
+        self.review.gate.set()
+        self.wait_for_reviews(2)
+        self.assertEqual(self.review.reviewed, [1, 2])
+
+    def test_repush_during_review(self):
+        self.assertEqual(self.post(1, action="opened"), 202)
+        self.assertTrue(self.review.started.wait(10))
+        # Pushed twice while it is reviewed: reviewed once more
+        self.assertEqual(self.post(1), 202)
+        self.assertEqual(self.post(1), 202)
+        self.review.gate.set()
+        self.wait_for_reviews(2)
+        self.assertEqual(self.review.reviewed, [1, 1])
+
+
+class FailingPoller(Poller):
+    """
+    Poller whose polls raise errors other than network errors.
+    """
+
+    def __init__(self):
+        Poller.__init__(self, URLs(), None, interval=0.01)
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+        raise TypeError("unexpected payload")
+
+
+class TestPoller(unittest.TestCase):
+
+    def test_keeps_polling_after_errors(self):
+        poller = FailingPoller()
+        poller.start()
+        deadline = time.time() + 10
+        while poller.polls < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        poller.stop()
+        poller.join(10)
+        self.assertTrue(poller.polls >= 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
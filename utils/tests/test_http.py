@@ -0,0 +1,62 @@
+"""
+Tests of the pool of keep-alive connections.
+
+Run them with:
+
+    python -m unittest discover utils/tests
+"""
+
+import os
+import unittest
+
+from utils.http import ConnectionPool
+
+
+class StubConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool()
+        self.key = ("https", "api.github.com")
+        self.connection = StubConnection()
+        self.pool._put(self.key, self.connection)
+
+    def test_reuses_idle_connections(self):
+        connection, reused = self.pool._get(self.key)
+        self.assertTrue(connection is self.connection)
+        self.assertTrue(reused)
+
+    def test_forked_process_does_not_reuse(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Child: report the result through the pipe, and never return
+            # into the test runner
+            try:
+                connection, reused = self.pool._get(self.key)
+                ok = not reused and connection is not self.connection and \
+                    not self.connection.closed
+                os.write(w, "ok" if ok else "reused")
+            finally:
+                os._exit(0)
+        os.close(w)
+        result = os.read(r, 100)
+        os.close(r)
+        os.waitpid(pid, 0)
+        self.assertEqual(result, "ok")
+        # The parent still has its idle connection
+        connection, reused = self.pool._get(self.key)
+        self.assertTrue(connection is self.connection)
+        self.assertTrue(reused)
+
+
+if __name__ == "__main__":
+    unittest.main()
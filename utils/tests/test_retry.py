@@ -0,0 +1,52 @@
+"""
+Tests of the circuit breakers of remote services.
+
+Run them with:
+
+    python -m unittest discover utils/tests
+"""
+
+import time
+import unittest
+
+from utils.retry import CircuitBreaker
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker("example.com", failure_threshold=2,
+            reset_timeout=0.2)
+
+    def open(self):
+        for i in range(2):
+            self.assertEqual(self.breaker.acquire(), 0)
+            self.breaker.record_failure()
+        self.assertTrue(self.breaker.acquire() > 0)
+        time.sleep(0.25)
+
+    def test_closes_after_successful_trial(self):
+        self.open()
+        self.assertEqual(self.breaker.acquire(), 0)
+        # Only one call at a time is let through
+        self.assertTrue(self.breaker.acquire() > 0)
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.acquire(), 0)
+
+    def test_opens_again_after_failed_trial(self):
+        self.open()
+        self.assertEqual(self.breaker.acquire(), 0)
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.acquire() > 0.1)
+
+    def test_interrupted_trial(self):
+        self.open()
+        # The trial call never records its outcome
+        self.assertEqual(self.breaker.acquire(), 0)
+        self.assertTrue(self.breaker.acquire() > 0)
+        time.sleep(0.25)
+        self.assertEqual(self.breaker.acquire(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Maps the source files of sympy to the test functions that execute them.
+
+Run it from the root of a sympy checkout, with the interpreter whose tests
+should be mapped:
+
+    python trace_tests.py OUTPUT
+
+It runs every test function (except the slow ones) with a tracer that records
+the files under sympy/ whose functions are called, and writes a JSON object
+mapping each of these files (relative to the root) to the list of test ids
+("path/to/test_file.py::test_function") that executed it. The cache of sympy
+is cleared before each test function, so that it calls everything it
+depends on.
+
+This script is run by the interpreters under test, so it has to work with
+both Python 2 and Python 3.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import types
+
+
+def find_test_files(package="sympy"):
+    for root, dirs, files in os.walk(package):
+        dirs.sort()
+        if os.path.basename(root) != "tests":
+            continue
+        for filename in sorted(files):
+            if filename.startswith("test_") and filename.endswith(".py"):
+                yield os.path.join(root, filename)
+
+
+def main():
+    output = sys.argv[1]
+    root = os.getcwd()
+    sys.path.insert(0, root)
+    prefix = os.path.join(root, "sympy") + os.sep
+    executed = set()
+
+    def tracer(frame, event, arg):
+        filename = frame.f_code.co_filename
+        if filename.startswith(prefix):
+            executed.add(filename)
+        # Only calls are traced, not lines, which would be much slower
+
+    try:
+        from sympy.core.cache import clear_cache
+    except ImportError:
+        def clear_cache():
+            pass
+
+    impact = {}
+    for test_file in find_test_files():
+        module_name = test_file[:-3].replace(os.sep, ".")
+        try:
+            module = __import__(module_name, fromlist=["*"])
+        except Exception as e:
+            print("Could not import %s: %s" % (module_name, e))
+            continue
+        for name in sorted(vars(module)):
+            func = getattr(module, name)
+            if not name.startswith("test_") or \
+                    not isinstance(func, types.FunctionType):
+                continue
+            if getattr(func, "_slow", False):
+                continue
+            # Otherwise the functions whose results were cached by earlier
+            # tests are not called, and their files are missed
+            clear_cache()
+            executed.clear()
+            sys.settrace(tracer)
+            try:
+                func()
+            except Exception:
+                # Failing tests still tell which files they execute
+                pass
+            finally:
+                sys.settrace(None)
+            test_id = "%s::%s" % (test_file, name)
+            for filename in executed:
+                path = os.path.relpath(filename, root)
+                impact.setdefault(path, []).append(test_id)
+        print("Traced %s" % test_file)
+        sys.stdout.flush()
+
+    with open(output, "w") as f:
+        json.dump(impact, f)
+
+
+if __name__ == "__main__":
+    main()